@@ -54,38 +54,406 @@ True
 
 
 import struct
+import bisect
 import itertools
+import collections
+import contextlib
+import hashlib
+import io
+import mmap
+import multiprocessing
+import os
+import tempfile
+import threading
+import zlib
 import six
 
+from multiprocessing.pool import ThreadPool
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 CLEAR_CODE = 256
 END_OF_INFO_CODE = 257
 
 DEFAULT_MIN_BITS = 9
 DEFAULT_MAX_BITS = 12
 
+DEFAULT_PRESET_ENTRIES = 1024
+DEFAULT_CHUNK_SIZE = 2**16
 
+# A compressed stream can never begin with a byte above 0x80 (its
+# first code is a literal or a control code, 9 bits wide), so bytes
+# up there are free to mark out-of-band framing.
+PRESET_MARKER = 0xFE
+PAGE_MARKER = 0xFF
+CHANNEL_MARKER = 0xFD
 
 
-def compress(plaintext_bytes):
+def compress(plaintext_bytes, preset=None, early_change=None, lookahead=0):
     """
     Given an iterable of bytes, returns a (hopefully shorter) iterable
     of bytes that you can store in a file or pass over the network or
     what-have-you, and later use to get back your original bytes with
     L{decompress}. This is the best place to start using this module.
+
+    If preset is given, it should be a L{PresetDictionary}, and the
+    same dictionary will be needed to decompress the result.
+
+    If early_change is given, the result is a PDF LZWDecode stream
+    with that EarlyChange (see L{ByteEncoder}.) A lookahead of 1 or
+    2 trades time for a smaller result (see L{FlexibleEncoder}.)
     """
-    encoder = ByteEncoder()
+    encoder = ByteEncoder(preset=preset, early_change=early_change, lookahead=lookahead)
     return encoder.encodetobytes(plaintext_bytes)
 
 
-def decompress(compressed_bytes):
+def decompress(compressed_bytes, preset=None, max_output=None, max_ratio=None, early_change=None):
     """
     Given an iterable of bytes that were the result of a call to
     L{compress}, returns an iterator over the uncompressed bytes.
+
+    preset may be a L{PresetDictionary} or a sequence of them, and is
+    required to decompress streams compressed with a preset.
+
+    For untrusted input, max_output limits the count of uncompressed
+    bytes, and max_ratio the count of uncompressed bytes per
+    compressed byte decoded; a L{DecompressionLimitError} is raised as
+    soon as either is exceeded. An L{InvalidCodeError} is raised on
+    codes that can't be decoded.
+
+    To decompress a PDF LZWDecode stream, pass its EarlyChange (1
+    unless the stream's DecodeParms say otherwise) as early_change.
+
+    >>> import lzw
+    >>> pdfstream = b"\\x80\\x0b\\x60\\x50\\x22\\x0c\\x0c\\x85\\x01"
+    >>> b"".join(lzw.decompress(pdfstream, early_change=1)) == b"-----A---B"
+    True
     """
-    decoder = ByteDecoder()
+    decoder = ByteDecoder(preset=preset, max_output=max_output, max_ratio=max_ratio,
+                          early_change=early_change)
     return decoder.decodefrombytes(compressed_bytes)
 
 
+def decompress_into(compressed_bytes, out, preset=None, max_ratio=None, early_change=None):
+    """
+    Like L{decompress}, but writes the uncompressed bytes into out, a
+    writable buffer (a bytearray, memoryview, mmap, numpy array...)
+    owned by the caller, and returns the number of bytes written.
+    out is never grown: if the output doesn't fit, out is filled and
+    a L{BufferTooSmallError} is raised. max_ratio and early_change
+    are as for L{decompress}.
+
+    >>> import lzw
+    >>> compressed = b"".join(lzw.compress(b"gabba gabba yo gabba"))
+    >>> out = bytearray(32)
+    >>> lzw.decompress_into(compressed, out)
+    20
+    >>> out[:20] == b"gabba gabba yo gabba"
+    True
+    >>> lzw.decompress_into(compressed, bytearray(8)) # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+    ...
+    BufferTooSmallError: needs more space: output buffer full after 8 bytes
+    """
+    decoder = ByteDecoder(preset=preset, max_ratio=max_ratio, early_change=early_change)
+    return decoder.decodeinto(compressed_bytes, out)
+
+
+
+def decompress_head(compressed_bytes, size, preset=None, early_change=None, chunksize=1024):
+    """
+    Returns (at most) the first size bytes that compressed_bytes
+    decompress to, as a byte string, unpacking and decoding no more
+    than it has to. compressed_bytes may be a binary file object (or
+    anything with a read method), which is read chunksize bytes at a
+    time, and not past the chunk the size'th byte comes from. preset
+    and early_change are as for L{decompress}.
+
+    >>> import lzw, io
+    >>> compressed = io.BytesIO(b"".join(lzw.compress(b"gabba gabba yo gabba" * 1000)))
+    >>> lzw.decompress_head(compressed, 14, chunksize=16) == b"gabba gabba yo"
+    True
+    >>> compressed.tell() == 16
+    True
+    """
+    if hasattr(compressed_bytes, "read"):
+        chunks = iter(lambda: compressed_bytes.read(chunksize), b"")
+    else:
+        chunks = _bytechunks(compressed_bytes, chunksize)
+
+    decoder = ByteDecoder(preset=preset, early_change=early_change)
+    head = []
+    remaining = size
+    for chunk in chunks:
+        for decoded in decoder._decodestrings(chunk):
+            head.append(decoded[:remaining])
+            remaining = remaining - len(decoded)
+            if remaining <= 0:
+                return b"".join(head)
+
+    return b"".join(head)
+
+
+def decompressed_size(compressed_bytes, preset=None, early_change=None):
+    """
+    Returns the size compressed_bytes would decompress to, without
+    decompressing them: only the lengths of the codebook's entries are
+    tracked, not their bytes. preset and early_change are as for
+    L{decompress}.
+
+    >>> import lzw
+    >>> lzw.decompressed_size(lzw.compress(b"gabba gabba yo gabba"))
+    20
+    """
+    return sum(decompressed_page_sizes(compressed_bytes, preset=preset, early_change=early_change))
+
+
+def decompressed_page_sizes(compressed_bytes, preset=None, early_change=None):
+    """
+    Like L{decompressed_size}, but returns a list of the decompressed
+    size of each page of a paged stream (see L{PagingEncoder}.)
+
+    >>> import lzw
+    >>> enc = lzw.PagingEncoder(258, 2**12, checksums=True)
+    >>> lzw.decompressed_page_sizes(enc.encodepages([ b"say hammer", b"yo hammer" ]))
+    [10, 9]
+    """
+    decoder = ByteDecoder(preset=preset, early_change=early_change)
+    return decoder.measure(compressed_bytes)
+
+
+
+def compress_many(payloads, max_width=DEFAULT_MAX_BITS, preset=None, workers=None):
+    """
+    Given a sequence of byte strings, returns a list of their
+    compressed byte strings, just as L{compress} would make them. A
+    single L{ByteEncoder} is reused for every payload, so there's no
+    per-payload setup beyond clearing its codebook, which makes this
+    a lot quicker than calling L{compress} on lots of small payloads.
+
+    If workers is more than one, the payloads are split into shards
+    and compressed in a pool of that many processes.
+
+    >>> import lzw
+    >>> compressed = lzw.compress_many([ b"gabba gabba", b"yo gabba" ])
+    >>> compressed[1] == b"".join(lzw.compress(b"yo gabba"))
+    True
+    >>> lzw.decompress_many(compressed) == [ b"gabba gabba", b"yo gabba" ]
+    True
+    """
+    if workers and workers > 1:
+        return _sharded(_compress_shard, payloads, workers, (max_width, preset))
+
+    encoder = ByteEncoder(max_width=max_width, preset=preset)
+    return [ encoder.encodechunk(payload) + encoder.flush() for payload in payloads ]
+
+
+def decompress_many(compressed_payloads, preset=None, workers=None):
+    """
+    Dual of L{compress_many}. Given a sequence of compressed byte
+    strings, returns a list of their uncompressed byte strings,
+    reusing a single L{ByteDecoder}, and optionally a pool of workers
+    processes.
+    """
+    if workers and workers > 1:
+        return _sharded(_decompress_shard, compressed_payloads, workers, (preset,))
+
+    decoder = ByteDecoder(preset=preset)
+    decompressed = []
+    for payload in compressed_payloads:
+        decoder.reset()
+        decompressed.append(decoder.decodechunk(payload))
+
+    return decompressed
+
+
+def _sharded(function, payloads, workers, arguments):
+    payloads = list(payloads)
+    shardsize = max(1, -(-len(payloads) // (workers * 4)))
+    shards = [ (payloads[start:start + shardsize],) + arguments
+               for start in range(0, len(payloads), shardsize) ]
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        results = pool.map(function, shards)
+    finally:
+        pool.close()
+        pool.join()
+
+    return [ result for shard in results for result in shard ]
+
+
+def _compress_shard(arguments):
+    (payloads, max_width, preset) = arguments
+    return compress_many(payloads, max_width=max_width, preset=preset)
+
+
+def _decompress_shard(arguments):
+    (payloads, preset) = arguments
+    return decompress_many(payloads, preset=preset)
+
+
+class CodecPool(object):
+    """
+    A thread safe pool of idle L{ByteEncoder}s and L{ByteDecoder}s,
+    so that services working through lots of short streams pay for a
+    codebook reset per stream rather than for building codecs. Codecs
+    are reset as they're returned to the pool.
+
+    >>> import lzw
+    >>> pool = lzw.CodecPool()
+    >>> with pool.encoder() as enc:
+    ...     compressed = enc.encodechunk(b"gabba gabba yo gabba") + enc.flush()
+    >>> with pool.decoder() as dec:
+    ...     dec.decodechunk(compressed) == b"gabba gabba yo gabba"
+    True
+    >>> pool.decompress(pool.compress(b"yo")) == b"yo"
+    True
+    """
+
+    def __init__(self, max_width=DEFAULT_MAX_BITS, preset=None, max_idle=64):
+        """
+        max_width and preset are as for L{ByteEncoder} and
+        L{ByteDecoder}. At most max_idle codecs of each kind are kept.
+        """
+        self._max_width = max_width
+        self._preset = preset
+        self._max_idle = max_idle
+
+        self._encoders = []
+        self._decoders = []
+        self._lock = threading.Lock()
+
+
+    def acquireencoder(self):
+        """
+        Returns an idle ByteEncoder, or a new one. Hand it back with
+        L{releaseencoder}.
+        """
+        with self._lock:
+            if self._encoders:
+                return self._encoders.pop()
+
+        return ByteEncoder(max_width=self._max_width, preset=self._preset)
+
+
+    def releaseencoder(self, encoder):
+        encoder.reset()
+        with self._lock:
+            if len(self._encoders) < self._max_idle:
+                self._encoders.append(encoder)
+
+
+    def acquiredecoder(self):
+        """
+        Returns an idle ByteDecoder, or a new one. Hand it back with
+        L{releasedecoder}.
+        """
+        with self._lock:
+            if self._decoders:
+                return self._decoders.pop()
+
+        return ByteDecoder(preset=self._preset)
+
+
+    def releasedecoder(self, decoder):
+        decoder.reset()
+        with self._lock:
+            if len(self._decoders) < self._max_idle:
+                self._decoders.append(decoder)
+
+
+    @contextlib.contextmanager
+    def encoder(self):
+        """
+        Context manager lending out a ByteEncoder from the pool.
+        """
+        encoder = self.acquireencoder()
+        try:
+            yield encoder
+        finally:
+            self.releaseencoder(encoder)
+
+
+    @contextlib.contextmanager
+    def decoder(self):
+        """
+        Context manager lending out a ByteDecoder from the pool.
+        """
+        decoder = self.acquiredecoder()
+        try:
+            yield decoder
+        finally:
+            self.releasedecoder(decoder)
+
+
+    def compress(self, data):
+        """
+        Compresses the byte string data with a pooled encoder,
+        returning a byte string.
+        """
+        with self.encoder() as encoder:
+            return encoder.encodechunk(data) + encoder.flush()
+
+
+    def decompress(self, data):
+        """
+        Decompresses the byte string data with a pooled decoder,
+        returning a byte string.
+        """
+        with self.decoder() as decoder:
+            return decoder.decodechunk(data)
+
+
+
+def open(filename, mode="rb", max_width=DEFAULT_MAX_BITS, page_size=None, preset=None,
+         buffersize=DEFAULT_CHUNK_SIZE, checksums=False):
+    """
+    Opens an lzw compressed file for reading or writing, after
+    gzip.open. filename may be a file name or an existing binary file
+    object. mode is "rb" (or "r"), "wb" (or "w"), or "ab" (or "a") to
+    add pages to a paged file. Returns an io.BufferedReader or
+    io.BufferedWriter (with buffersize bytes of buffer) over an
+    L{LZWFile}. See L{LZWFile} for the rest of the arguments.
+
+    >>> import lzw, io
+    >>> stream = io.BytesIO()
+    >>> with lzw.open(stream, "wb") as outfile:
+    ...     count = outfile.write(b"gabba gabba yo gabba")
+    >>> stream.getvalue() == b"".join(lzw.compress(b"gabba gabba yo gabba"))
+    True
+    >>> with lzw.open(io.BytesIO(stream.getvalue())) as infile:
+    ...     infile.read() == b"gabba gabba yo gabba"
+    True
+    """
+    if hasattr(filename, "read") or hasattr(filename, "write"):
+        raw = LZWFile(mode=mode, fileobj=filename, max_width=max_width, page_size=page_size,
+                      preset=preset, buffersize=buffersize, checksums=checksums)
+    else:
+        raw = LZWFile(filename, mode=mode, max_width=max_width, page_size=page_size,
+                      preset=preset, buffersize=buffersize, checksums=checksums)
+
+    if raw.readable():
+        return io.BufferedReader(raw, buffersize)
+
+    return io.BufferedWriter(raw, buffersize)
+
+
+
+class BufferTooSmallError(ValueError):
+    """
+    Raised when uncompressed output needs more space than the
+    caller's buffer has. written is the count of bytes written before
+    giving up, which is the whole of the buffer.
+    """
+    def __init__(self, written):
+        ValueError.__init__(self, "needs more space: output buffer full after {0} bytes".format(written))
+        self.written = written
+
+
 
 
 
@@ -111,15 +479,53 @@ class ByteEncoder(object):
     >>> decoded == bigstr
     True
 
+    Given an early_change, writes PDF LZWDecode streams instead, with
+    that EarlyChange: they start with a CLEAR_CODE, end with an
+    END_OF_INFO_CODE (PDF's EOD), and no code is wider than max_width
+    bits. Our own streams change width like EarlyChange 1, but may
+    widen the last code before a clear past max_width.
+
+    >>> enc = lzw.ByteEncoder(early_change=1)
+    >>> enc.encodechunk(b"-----A---B") + enc.flush() == b"\\x80\\x0b\\x60\\x50\\x22\\x0c\\x0c\\x85\\x01"
+    True
     """
 
-    def __init__(self, max_width=DEFAULT_MAX_BITS):
+    def __init__(self, max_width=DEFAULT_MAX_BITS, preset=None, early_change=None, lookahead=0):
        """
        max_width is the maximum width in bits we want to see in the
-       output stream of codepoints.
+       output stream of codepoints. preset is an optional
+       L{PresetDictionary} used to prime the codebook; its id is
+       written at the head of the output stream. early_change, if
+       given, is the EarlyChange of the PDF stream to write. If
+       lookahead is more than 0, a L{FlexibleEncoder} looking that
+       far ahead is used, for smaller output at a higher cost.
        """
-       self._encoder = Encoder(max_code_size=2**max_width)
-       self._packer = BitPacker(initial_code_size=self._encoder.code_size())
+       if early_change is not None and preset is not None:
+           raise ValueError("PDF streams can't use a preset dictionary")
+
+       self._preset = preset
+       self._early_change = early_change
+       self._max_width = max_width
+       self._started = False
+       self.bytes_in = 0
+       self.bytes_out = 0
+
+       max_code_size = 2**max_width
+       if early_change is not None:
+           # Clear early enough that the codes flushed before the
+           # clear still fit in max_width bits.
+           max_code_size = max_code_size - 1 - early_change
+
+       if lookahead:
+           self._encoder = FlexibleEncoder(max_code_size=max_code_size, preset=preset, lookahead=lookahead)
+       else:
+           self._encoder = Encoder(max_code_size=max_code_size, preset=preset)
+
+       if early_change is None:
+           self._packer = BitPacker(initial_code_size=self._encoder.code_size())
+       else:
+           self._packer = BitPacker(initial_code_size=self._encoder.code_size(),
+                                    early_change=early_change, max_width=max_width)
 
 
     def encodetobytes(self, bytesource):
@@ -128,12 +534,159 @@ class ByteEncoder(object):
         between minwidth and maxwidth when it detects an overflow is
         about to occur. Dual of L{ByteDecoder.decodefrombytes}.
         """
+        if self._early_change is not None:
+            return self._encodetopdf(bytesource)
+
         codepoints = self._encoder.encode(bytesource)
         codebytes = self._packer.pack(codepoints)
 
+        if self._preset is not None:
+            header = [ six.int2byte(b) for b in six.iterbytes(self._preset.header()) ]
+            codebytes = itertools.chain(header, codebytes)
+
         return codebytes
 
 
+    def encodechunk(self, data):
+        """
+        Given a bytes-like chunk of uncompressed input, returns a byte
+        string of the compressed bytes it completes, keeping partial
+        prefixes and bits back for the next chunk. Call L{flush} at
+        the end of the stream.
+
+        >>> import lzw
+        >>> enc = lzw.ByteEncoder()
+        >>> compressed = enc.encodechunk(b"gabba gabba ") + enc.encodechunk(b"yo gabba") + enc.flush()
+        >>> compressed == b"".join(lzw.compress(b"gabba gabba yo gabba"))
+        True
+        """
+        head = b""
+        if not self._started:
+            self._started = True
+            if self._preset is not None:
+                head = self._preset.header()
+            elif self._early_change is not None:
+                head = self._packer.packchunk([ CLEAR_CODE ])
+
+        packed = head + self._packer.packchunk(self._encoder.encodechunk(data))
+        self.bytes_in = self.bytes_in + len(data)
+        self.bytes_out = self.bytes_out + len(packed)
+
+        return packed
+
+
+    def flush(self):
+        """
+        Ends the stream started by L{encodechunk}, returning the last
+        of its bytes. The next call to L{encodechunk} starts a new
+        stream.
+        """
+        head = self.encodechunk(b"")
+        self._started = False
+
+        endcode = CLEAR_CODE
+        if self._early_change is not None:
+            endcode = END_OF_INFO_CODE
+
+        tail = self._packer.packchunk(self._encoder.flush(endcode)) + self._packer.flush()
+        self.bytes_out = self.bytes_out + len(tail)
+
+        return head + tail
+
+
+    def checkpoint(self):
+        """
+        Returns a compact snapshot of the stream in progress (its
+        codebook, buffered prefix and bits, and the bytes_in and
+        bytes_out counts of what's gone through L{encodechunk} and
+        L{flush}) as a byte string, for L{restore}.
+
+        To pick up after a crash, truncate the output to the
+        checkpoint's bytes_out, restore, and go on encoding input
+        from its bytes_in.
+
+        >>> import lzw
+        >>> enc = lzw.ByteEncoder()
+        >>> head = enc.encodechunk(b"gabba gabba ")
+        >>> snapshot = enc.checkpoint()
+        >>> resumed = lzw.ByteEncoder()
+        >>> resumed.restore(snapshot)
+        >>> resumed.bytes_in, resumed.bytes_out == len(head)
+        (12, True)
+        >>> head + resumed.encodechunk(b"yo gabba") + resumed.flush() == b"".join(lzw.compress(b"gabba gabba yo gabba"))
+        True
+        """
+        encoder = self._encoder
+        if isinstance(encoder, FlexibleEncoder):
+            raise ValueError("Lookahead encoders can't be checkpointed")
+
+        prefixes = encoder._prefixes
+        initial = len(encoder._initial_prefixes)
+        entries = sorted((code, entry) for (entry, code) in prefixes.items() if code >= initial)
+
+        pending = None
+        if encoder._buffer:
+            pending = prefixes[ encoder._buffer ]
+
+        head = _checkpointheader(b"E", self._started, self._early_change, self._preset,
+                                 self.bytes_in, self.bytes_out, max_width=self._max_width)
+
+        return (head + _dumpbits(self._packer) +
+                _dumpcodebook(prefixes, initial, [ entry for (code, entry) in entries ], pending))
+
+
+    def restore(self, checkpoint):
+        """
+        Picks up the stream snapshotted by L{checkpoint}. The
+        ByteEncoder should have been made with the same max_width,
+        preset and early_change as the one snapshotted. Raises a
+        ValueError if the checkpoint doesn't fit it.
+        """
+        checkpoint = bytes(checkpoint)
+        (started, dictionary_id, bytes_in, bytes_out, offset) = _readcheckpoint(
+            checkpoint, b"E", self._early_change, max_width=self._max_width)
+
+        if dictionary_id != (self._preset and self._preset.dictionary_id):
+            raise ValueError("Checkpoint was taken with a different preset dictionary")
+
+        encoder = self._encoder
+        initialstrings = dict((code, entry) for (entry, code) in encoder._initial_prefixes.items())
+
+        offset = _loadbits(self._packer, checkpoint, offset)
+        (entries, pending, offset) = _loadcodebook(checkpoint, offset, initialstrings)
+
+        encoder.reset()
+        for (code, entry) in enumerate(entries, len(initialstrings)):
+            encoder._prefixes[ entry ] = code
+        encoder._buffer = pending or b""
+
+        self._started = started
+        self.bytes_in = bytes_in
+        self.bytes_out = bytes_out
+
+
+    def _encodetopdf(self, bytesource):
+        self.reset()
+        for piece in _bytepieces(bytesource):
+            for bt in six.iterbytes(self.encodechunk(piece)):
+                yield six.int2byte(bt)
+
+        for bt in six.iterbytes(self.flush()):
+            yield six.int2byte(bt)
+
+
+    def reset(self):
+        """
+        Drops any stream in progress, readying the ByteEncoder for a
+        new one.
+        """
+        self._started = False
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._encoder.reset()
+        self._packer.reset()
+
+
 class ByteDecoder(object):
     """
     Decodes, combines bit-unpacking and interpreting a codepoint
@@ -141,541 +694,3032 @@ class ByteDecoder(object):
     L{ByteEncoder}.
 
     See L{ByteDecoder} for a usage example.
+
+    For untrusted input, a ByteDecoder can be limited to max_output
+    uncompressed bytes, or to max_ratio uncompressed bytes for every
+    compressed byte decoded so far, raising a L{DecompressionLimitError}
+    before it produces more than that.
+
+    >>> import lzw
+    >>> bomb = b"".join(lzw.compress(b"\\0" * 100000))
+    >>> dec = lzw.ByteDecoder(max_ratio=50)
+    >>> b"".join(dec.decodefrombytes(bomb)) # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+    ...
+    DecompressionLimitError: Expansion ratio limit of 50 exceeded
+
+    Given an early_change, decodes PDF LZWDecode streams with that
+    EarlyChange, stopping at their END_OF_INFO_CODE (EOD) and
+    ignoring whatever follows it.
     """
-    def __init__(self):
+    def __init__(self, preset=None, max_output=None, max_ratio=None, early_change=None):
        """
+       preset may be a L{PresetDictionary}, or a sequence of them,
+       any of which may be named by the id at the head of a stream
+       compressed with a preset. max_output and max_ratio are
+       optional limits on the output. early_change, if given, is the
+       EarlyChange of the PDF stream to decode.
        """
+       if early_change is not None and preset:
+           raise ValueError("PDF streams can't use a preset dictionary")
+
+       self.max_output = max_output
+       self.max_ratio = max_ratio
+       self._early_change = early_change
+
+       if isinstance(preset, PresetDictionary):
+           preset = [ preset ]
 
+       self._presets = dict((p.dictionary_id, p) for p in (preset or []))
        self._decoder = Decoder()
-       self._unpacker = BitUnpacker(initial_code_size=self._decoder.code_size())
+       if early_change is None:
+           self._unpacker = BitUnpacker(initial_code_size=self._decoder.code_size())
+       else:
+           self._unpacker = BitUnpacker(initial_code_size=self._decoder.code_size(),
+                                        early_change=early_change, max_width=DEFAULT_MAX_BITS)
        self.remaining = []
 
+       self._codecs = { None: (self._decoder, self._unpacker) }
+
+       self._head = bytearray()
+       self._pagestart = True
+       self._ended = False
+       self.bytes_in = 0
+       self.bytes_out = 0
+       self.pages = [ (0, 0) ]
+
+       # Long-lived decoders that never seek (a Demultiplexer's)
+       # turn this off, to only remember the page in progress
+       self._keeppages = True
+
     def decodefrombytes(self, bytesource):
        """
        Given an iterator over BitPacked, Encoded bytes, Returns an
        iterator over the uncompressed bytes. Dual of
        L{ByteEncoder.encodetobytes}. See L{ByteEncoder} for an
        example of use.
+
+       Raises a ValueError if the stream names a preset dictionary
+       this decoder wasn't given, and an L{InvalidCodeError} at the
+       first code that can't be decoded.
        """        
-       codepoints = self._unpacker.unpack(bytesource)
-       clearbytes = self._decoder.decode(codepoints)
-       
-       return clearbytes
+       for piece in _bytepieces(bytesource):
+           for decoded in self._decodestrings(piece):
+               for i in range(len(decoded)):
+                   yield decoded[i:i + 1]
 
 
-class BitPacker(object):
-    """
-    Translates a stream of lzw codepoints into a variable width packed
-    stream of bytes, for use by L{BitUnpacker}.  One of a (potential)
-    set of encoders for a stream of LZW codepoints, intended to behave
-    as closely to the TIFF variable-width encoding as possible.
+    def decodeinto(self, bytesource, out):
+       """
+       Decodes bytesource into the writable buffer out, a whole
+       decoded string at a time, and returns the count of bytes
+       written. Raises a L{BufferTooSmallError} (after filling out)
+       if out is too small. See L{decompress_into}.
+       """
+       view = _byteview(out)
 
-    The inbound stream of integer lzw codepoints are packed into
-    variable width bit fields, starting at the smallest number of bits
-    it can and then increasing the bit width as it anticipates the LZW
-    code size growing to overflow.
+       size = len(view)
+       written = 0
+       for chunk in _bytechunks(bytesource):
+           for decoded in self._decodestrings(chunk):
+               end = written + len(decoded)
+               if end > size:
+                   view[written:size] = decoded[:size - written]
+                   raise BufferTooSmallError(size)
 
-    This class knows all kinds of intimate things about how it's
-    upstream codepoint processors work; it knows the control codes
-    CLEAR_CODE and END_OF_INFO_CODE, and (more intimately still), it
-    makes assumptions about the rate of growth of it's consumer's
-    codebook. This is ok, as long as the underlying encoder/decoders
-    don't know any intimate details about their BitPackers/Unpackers
-    """
+               view[written:end] = decoded
+               written = end
 
-    def __init__(self, initial_code_size):
+       return written
+
+
+    def decodechunk(self, data):
        """
-       Takes an initial code book size (that is, the count of known
-       codes at the beginning of encoding, or after a clear)
+       Given a bytes-like chunk of a compressed stream, returns the
+       uncompressed bytes it completes, keeping any trailing partial
+       codepoint for the next chunk.
+
+       END_OF_INFO_CODE ends a page (see L{PagingEncoder}): the
+       codebook is cleared, and the page boundary is noted in pages,
+       a list of (bytes_in, bytes_out) offsets at which each page
+       starts. So a paged stream decodes to its pages, back to back.
+       Page checksum headers are skipped, not checked.
+
+       >>> import lzw
+       >>> compressed = b"".join(lzw.compress(b"gabba gabba yo gabba"))
+       >>> dec = lzw.ByteDecoder()
+       >>> dec.decodechunk(compressed[:5]) + dec.decodechunk(compressed[5:]) == b"gabba gabba yo gabba"
+       True
+       >>> dec.bytes_in, dec.bytes_out
+       (17, 20)
        """
-       self._initial_code_size = initial_code_size
+       return b"".join(self._decodestrings(data))
 
 
-    def pack(self, codepoints):
-        """
-        Given an iterator of integer codepoints, returns an iterator
-        over bytes containing the codepoints packed into varying
-        lengths, with bit width growing to accomodate an input code
-        that it assumes will grow by one entry per codepoint seen.
+    def measure(self, bytesource):
+       """
+       Runs through the compressed bytesource as L{decodefrombytes}
+       would, but only working out the length of each decoded string,
+       not the string itself. Returns a list of the decompressed size
+       of each page (a stream that isn't paged is one page.) See
+       L{decompressed_size}.
+       """
+       initiallengths = {}
+       lengths = None
+
+       for chunk in _bytechunks(bytesource):
+           for (codepoints, endofpage) in self._unpackpages(chunk):
+               if lengths is None:
+                   initial = self._decoder._initial_codepoints
+                   if id(initial) not in initiallengths:
+                       initiallengths[ id(initial) ] = [ len(initial[ code ]) if isinstance(initial[ code ], six.binary_type) else 0
+                                                         for code in range(len(initial)) ]
+                   initial = initiallengths[ id(initial) ]
+                   lengths = list(initial)
+                   previous = None
+
+               # Every new entry is one longer than the entry before it
+               total = 0
+               size = len(lengths)
+               for code in codepoints:
+                   if code == CLEAR_CODE:
+                       lengths = list(initial)
+                       size = len(lengths)
+                       previous = None
+                       continue
+
+                   if code < size:
+                       length = lengths[ code ]
+                       if previous is not None:
+                           lengths.append(previous + 1)
+                           size = size + 1
+                   elif code == size and previous is not None:
+                       length = previous + 1
+                       lengths.append(length)
+                       size = size + 1
+                   else:
+                       raise InvalidCodeError("Code {0} is beyond the codebook (size {1})".format(code, size))
+
+                   total = total + length
+                   previous = length
+
+               self.bytes_out = self.bytes_out + total
+               if endofpage:
+                   lengths = None
+
+       starts = [ page[1] for page in self.pages if page[0] < self.bytes_in ]
+       return [ end - start for (start, end) in zip(starts, starts[1:] + [ self.bytes_out ]) ]
+
+
+    def _decodestrings(self, data):
+       # Yields the decoded strings completed by a chunk of the
+       # stream, keeping track of limits.
+       if self.max_output is None and self.max_ratio is None:
+           for (codepoints, endofpage) in self._unpackpages(data):
+               for decoded in self._decoder.decodestrings(codepoints):
+                   self.bytes_out = self.bytes_out + len(decoded)
+                   yield decoded
+           return
+
+       # bytes_in runs ahead to the end of each batch of codepoints,
+       # so ratios are checked against the input decoded so far: the
+       # bytes before the batch, and at least the narrowest width for
+       # each of its codepoints.
+       before = self.bytes_in
+       for (codepoints, endofpage) in self._unpackpages(data):
+           decoder = self._decoder
+           minwidth = self._unpacker._minwidth
+           for (count, codepoint) in enumerate(codepoints, 1):
+               decoded = decoder._decode_codepoint(codepoint)
+               if not decoded:
+                   continue
+
+               self.bytes_out = self.bytes_out + len(decoded)
+               self._checklimits(min(before + count * minwidth // 8, self.bytes_in))
+               yield decoded
+
+           before = self.bytes_in
+
+
+    def _unpackpages(self, data):
+       # Yields lists of the codepoints completed by a chunk of the
+       # stream, with whether they end a page, keeping track of
+       # headers and pages. Page ends (END_OF_INFO_CODE, which is
+       # dropped) are seen to once the codepoints have been handled.
+       data = bytearray(data)
+       if self._head:
+           data = self._head + data
+           self._head = bytearray()
+
+       start = 0
+       while start < len(data) and not self._ended:
+           if self._pagestart and self._early_change is None:
+               # Pages may begin with a checksum header, and the stream
+               # with a preset dictionary header.
+               marker = data[start]
+               headersize = 0
+               if marker == PAGE_MARKER:
+                   headersize = _PAGE_HEADER_SIZE
+               elif marker == PRESET_MARKER and self.bytes_in == 0:
+                   headersize = 5
+
+               if len(data) - start < headersize:
+                   self._head = data[start:]
+                   break
+
+               self.bytes_in = self.bytes_in + headersize
+               start = start + headersize
+
+               # The first page, and its header, follow a preset header
+               if marker == PRESET_MARKER and headersize:
+                   (dictionary_id,) = struct.unpack(">I", bytes(data[start - 4:start]))
+                   self._usepreset(dictionary_id)
+               else:
+                   self._pagestart = False
+               continue
+
+           (codepoints, end) = self._unpacker.unpackpage(data, start)
+           self.bytes_in = self.bytes_in + (end - start)
+           start = end
+
+           endofpage = bool(codepoints) and codepoints[-1] == END_OF_INFO_CODE
+           if endofpage:
+               codepoints.pop()
+
+           yield (codepoints, endofpage)
+
+           if endofpage:
+               self._decoder.reset()
+               self._pagestart = True
+               self._ended = self._early_change is not None
+               if self.bytes_in > self.pages[-1][0]:
+                   if not self._keeppages:
+                       del self.pages[:]
+                   self.pages.append((self.bytes_in, self.bytes_out))
+
+
+    def _checklimits(self, bytes_in):
+       if self.max_output is not None and self.bytes_out > self.max_output:
+           raise DecompressionLimitError("Output limit of {0} bytes exceeded".format(self.max_output))
+
+       if self.max_ratio is not None and self.bytes_out > self.max_ratio * max(bytes_in, 1):
+           raise DecompressionLimitError("Expansion ratio limit of {0} exceeded".format(self.max_ratio))
+
+
+    def reset(self):
+       """
+       Readies the ByteDecoder for a new stream, forgetting any
+       partial input, pages and counts.
+       """
+       self._restartat((0, 0))
+       self.pages = [ (0, 0) ]
 
-        Widths will be reset to the given initial_code_size when the
-        LZW CLEAR_CODE or END_OF_INFO_CODE code appears in the input,
-        and bytes following END_OF_INFO_CODE will be aligned to the
-        next byte boundary.
 
-        >>> import lzw, six
-        >>> pkr = lzw.BitPacker(258)
-        >>> [ b for b in pkr.pack([ 1, 257]) ] == [ six.int2byte(0), six.int2byte(0xC0), six.int2byte(0x40) ]
-        True
-        """
-        tailbits = []
-        codesize = self._initial_code_size
+    def checkpoint(self):
+       """
+       Returns a compact snapshot of the stream in progress as a byte
+       string, for L{restore}: the codebook, the bits of any partial
+       codepoint (or partial page header), and the bytes_in and
+       bytes_out counts. Of pages, only the page in progress is kept.
+
+       To pick up after a crash, truncate the output to the
+       checkpoint's bytes_out, restore, and go on feeding the stream
+       from wherever it had got to when the checkpoint was taken.
+
+       >>> import lzw
+       >>> compressed = b"".join(lzw.compress(b"gabba gabba yo gabba"))
+       >>> dec = lzw.ByteDecoder()
+       >>> head = dec.decodechunk(compressed[:7])
+       >>> resumed = lzw.ByteDecoder()
+       >>> resumed.restore(dec.checkpoint())
+       >>> head + resumed.decodechunk(compressed[7:]) == b"gabba gabba yo gabba"
+       True
+       """
+       decoder = self._decoder
+       codepoints = decoder._codepoints
+       initial = len(decoder._initial_codepoints)
+       entries = [ codepoints[ code ] for code in range(initial, len(codepoints)) ]
+       # Flexible parsing streams can add a string twice, and the
+       # codebook format wants each prefix as its lowest code
+       codes = {}
+       for code in sorted(codepoints):
+           if code != CLEAR_CODE and code != END_OF_INFO_CODE:
+               codes.setdefault(codepoints[ code ], code)
+
+       pending = None
+       if decoder._prefix is not None:
+           pending = codes[ decoder._prefix ]
+
+       preset = None
+       for (dictionary_id, codec) in self._codecs.items():
+           if dictionary_id is not None and codec[0] is decoder:
+               preset = self._presets[ dictionary_id ]
+
+       head = _checkpointheader(b"D", self._pagestart, self._early_change, preset,
+                                self.bytes_in, self.bytes_out, self._ended)
+       tail = (struct.pack(">B", len(self._head)) + bytes(self._head) +
+               struct.pack(">QQ", *self.pages[-1]))
+
+       return head + _dumpbits(self._unpacker) + _dumpcodebook(codes, initial, entries, pending) + tail
+
+
+    def restore(self, checkpoint):
+       """
+       Picks up the stream snapshotted by L{checkpoint}. The
+       ByteDecoder should have been made with the same early_change
+       as the one snapshotted, and with its preset dictionary, if
+       the stream used one. Raises a ValueError if the checkpoint
+       doesn't fit it.
+       """
+       checkpoint = bytes(checkpoint)
+       (pagestart, dictionary_id, bytes_in, bytes_out, offset, ended) = _readcheckpoint(
+           checkpoint, b"D", self._early_change, ended=True)
 
-        minwidth = 8
-        while (1 << minwidth) < codesize:
-            minwidth = minwidth + 1
+       self._restartat((0, 0))
+       if dictionary_id is not None:
+           self._usepreset(dictionary_id)
 
-        nextwidth = minwidth
+       decoder = self._decoder
+       offset = _loadbits(self._unpacker, checkpoint, offset)
+       (entries, pending, offset) = _loadcodebook(checkpoint, offset, decoder._initial_codepoints)
+       for (code, entry) in enumerate(entries, len(decoder._initial_codepoints)):
+           decoder._codepoints[ code ] = entry
+       decoder._prefix = pending
 
-        for pt in codepoints:
+       (headsize,) = struct.unpack_from(">B", checkpoint, offset)
+       self._head = bytearray(checkpoint[offset + 1:offset + 1 + headsize])
+       self.pages = [ struct.unpack_from(">QQ", checkpoint, offset + 1 + headsize) ]
 
-            newbits = inttobits(pt, nextwidth)
-            tailbits = tailbits + newbits
+       self._pagestart = pagestart
+       self._ended = ended
+       self.bytes_in = bytes_in
+       self.bytes_out = bytes_out
 
-            # PAY ATTENTION. This calculation should be driven by the
-            # size of the upstream codebook, right now we're just trusting
-            # that everybody intends to follow the TIFF spec.
-            codesize = codesize + 1
+    def _restartat(self, page):
+       # Readies the push decoder to be handed the stream again,
+       # starting from page, one of our pages.
+       (self.bytes_in, self.bytes_out) = page
+       self._head = bytearray()
+       self._pagestart = True
+       self._ended = False
 
-            if pt == END_OF_INFO_CODE:
-               while len(tailbits) % 8:
-                  tailbits.append(0)
-                  
-            if pt in [ CLEAR_CODE, END_OF_INFO_CODE ]:
-                nextwidth = minwidth
-                codesize = self._initial_code_size
-            elif codesize >= (2 ** nextwidth):
-                nextwidth = nextwidth + 1
-
-            while len(tailbits) > 8:
-                nextbits = tailbits[:8]
-                nextbytes = bitstobytes(nextbits)
-                for bt in nextbytes:
-                    yield struct.pack("B", bt)
-
-                tailbits = tailbits[8:]
-
-                       
-        if tailbits:
-            tail = bitstobytes(tailbits)
-            for bt in tail:
-                yield struct.pack("B", bt)
+       if self.bytes_in == 0:
+           (self._decoder, self._unpacker) = self._codecs[ None ]
 
-                
+       self._unpacker.reset()
+       self._decoder.reset()
 
 
-class BitUnpacker(object):
+    def _usepreset(self, dictionary_id):
+       if dictionary_id not in self._presets:
+           raise ValueError("Stream requires unknown preset dictionary {0:#010x}".format(dictionary_id))
+
+       if dictionary_id not in self._codecs:
+           decoder = Decoder(preset=self._presets[dictionary_id])
+           unpacker = BitUnpacker(initial_code_size=decoder.code_size())
+           self._codecs[ dictionary_id ] = (decoder, unpacker)
+
+       (self._decoder, self._unpacker) = self._codecs[ dictionary_id ]
+       self._unpacker.reset()
+       self._decoder.reset()
+
+
+class InvalidCodeError(ValueError):
     """
-    An adaptive-width bit unpacker, intended to decode streams written
-    by L{BitPacker} into integer codepoints. Like L{BitPacker}, knows
-    about code size changes and control codes.
+    Raised by a L{Decoder} given a codepoint it can't make sense of,
+    one that's neither in its codebook nor the next code to be added.
     """
+    pass
 
-    def __init__(self, initial_code_size):
-       """
-       initial_code_size is the starting size of the codebook
-       associated with the to-be-unpacked stream.
-       """
-       self._initial_code_size = initial_code_size
 
 
-    def unpack(self, bytesource):
-        """
-        Given an iterator of bytes, returns an iterator of integer
-        code points. Auto-magically adjusts point width when it sees
-        an almost-overflow in the input stream, or an LZW CLEAR_CODE
-        or END_OF_INFO_CODE
+class DecompressionLimitError(ValueError):
+    """
+    Raised when decompressing would go over the max_output or
+    max_ratio limits given to a L{ByteDecoder} or L{decompress}.
+    """
+    pass
+
+
+
+class ChecksumError(ValueError):
+    """
+    Raised when a page of a checksummed paged stream (see
+    L{PagingEncoder}) doesn't match its checksums. page is the index
+    of the bad page.
+    """
+    def __init__(self, page, what):
+        ValueError.__init__(self, "Bad {0} checksum on page {1}".format(what, page))
+        self.page = page
+
+
+
+class LZWFile(io.RawIOBase):
+    """
+    A raw file object over an lzw compressed file, reading and writing
+    uncompressed bytes, after gzip.GzipFile. Most people will want
+    L{open}, which wraps one of these in a buffered reader or writer.
+
+    Reads decode the underlying file a chunk at a time, with
+    L{ByteDecoder.decodechunk}. If the underlying file is seekable, so
+    is an LZWFile opened for reading: seeking forwards decodes and
+    drops bytes up to the target, and seeking backwards starts over
+    from the latest page at or before the target (see
+    L{PagingEncoder}), or from the start of the stream when it isn't
+    paged. Paged streams decode to their pages back to back.
+
+    >>> import lzw, io
+    >>> stream = io.BytesIO()
+    >>> writer = lzw.LZWFile(mode="wb", fileobj=stream, page_size=8)
+    >>> writer.write(b"gabba gabba yo gabba")
+    20
+    >>> writer.close()
+    >>> reader = lzw.LZWFile(mode="rb", fileobj=io.BytesIO(stream.getvalue()))
+    >>> reader.seek(15)
+    15
+    >>> reader.read(5) == b"gabba"
+    True
+    >>> reader.seek(9)
+    9
+    >>> reader.read(5) == b"ba yo"
+    True
+
+    Paged files can be appended to, in mode "ab": new pages are
+    written after the last complete page already in the file (a
+    partly written page, from a writer that died, is cut off first),
+    with checksums if the file's pages have them.
+
+    >>> stream.seek(0) == 0
+    True
+    >>> appender = lzw.LZWFile(mode="ab", fileobj=stream, page_size=8)
+    >>> appender.write(b" yo!")
+    4
+    >>> appender.close()
+    >>> lzw.LZWFile(mode="rb", fileobj=io.BytesIO(stream.getvalue())).read() == b"gabba gabba yo gabba yo!"
+    True
+    """
+
+    def __init__(self, filename=None, mode="rb", fileobj=None, max_width=DEFAULT_MAX_BITS,
+                 page_size=None, preset=None, buffersize=DEFAULT_CHUNK_SIZE, checksums=False):
+        """
+        Opens filename, or wraps fileobj, a binary file object. When
+        writing, max_width and preset are as for L{ByteEncoder}, and
+        if page_size is given, the output is a paged stream, as from
+        L{PagingEncoder}, with a page for every page_size bytes
+        written, and page checksums if checksums is set. When
+        reading, preset is as for L{ByteDecoder}.
+        buffersize is the size of the chunks read from the underlying
+        file.
+
+        Appending needs a page_size, can't use a preset, and needs a
+        file (or fileobj) that can be read, written, seeked and
+        truncated. Raises a ValueError if the file isn't paged.
+        """
+        if mode not in ("r", "rb", "w", "wb", "a", "ab"):
+            raise ValueError("Invalid mode {0!r}".format(mode))
+
+        appending = mode.startswith("a")
+        if appending and (page_size is None or preset is not None):
+            raise ValueError("Appending needs a page_size, and no preset")
+
+        self._writing = mode.startswith("w") or appending
+        self._ownsfile = fileobj is None
+        if fileobj is None:
+            filemode = "wb" if self._writing else "rb"
+            if appending:
+                filemode = "r+b" if os.path.exists(filename) else "w+b"
+            fileobj = io.open(filename, filemode)
+
+        self._fileobj = fileobj
+        self._buffersize = buffersize
+
+        if self._writing:
+            self._encoder = Encoder(max_code_size=2**max_width, preset=preset)
+            self._packer = BitPacker(initial_code_size=self._encoder.code_size())
+            self._page_size = page_size
+            self._pagefill = 0
+            self._checksums = checksums
+            self._page = []
+            self._pagecrc = 0
+
+            if preset is not None:
+                self._fileobj.write(preset.header())
+
+            if appending:
+                self._seektail()
+        else:
+            self._decoder = ByteDecoder(preset=preset)
+            self._origin = 0
+            self._fileseekable = _isseekable(self._fileobj)
+            if self._fileseekable:
+                self._origin = self._fileobj.tell()
+
+            self._buffer = b""
+            self._offset = 0
+            self._pos = 0
+            self._eof = False
+
+
+    def readable(self):
+        return not self._writing
+
+
+    def writable(self):
+        return self._writing
+
+
+    def seekable(self):
+        return not self._writing and self._fileseekable
+
+
+    def readinto(self, b):
+        """
+        Reads up to len(b) uncompressed bytes into the writable buffer
+        b, returning the count read, or 0 at the end of the stream.
+        """
+        view = _byteview(b)
+
+        while self._offset >= len(self._buffer):
+            if not self._fill():
+                return 0
+
+        count = min(len(view), len(self._buffer) - self._offset)
+        view[:count] = self._buffer[self._offset:self._offset + count]
+
+        self._offset = self._offset + count
+        self._pos = self._pos + count
+
+        return count
+
+
+    def write(self, b):
+        """
+        Compresses and writes the bytes-like object b, returning its
+        length.
+        """
+        data = memoryview(b).tobytes()
+
+        if self._page_size is None:
+            self._fileobj.write(self._packer.packchunk(self._encoder.encodechunk(data)))
+            return len(data)
+
+        start = 0
+        while start < len(data):
+            if not self._pagefill:
+                self._page.append(self._packer.packchunk([ CLEAR_CODE ]))
+
+            count = min(len(data) - start, self._page_size - self._pagefill)
+            chunk = data[start:start + count]
+            self._page.append(self._packer.packchunk(self._encoder.encodechunk(chunk)))
+            self._pagecrc = zlib.crc32(chunk, self._pagecrc)
+            self._pagefill = self._pagefill + count
+            start = start + count
+
+            if self._pagefill == self._page_size:
+                self._endpage()
+
+        if not self._checksums:
+            self._fileobj.write(b"".join(self._page))
+            self._page = []
+
+        return len(data)
+
+
+    def tell(self):
+        if self._writing:
+            raise io.UnsupportedOperation("tell")
+
+        return self._pos
+
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        """
+        Moves to the given uncompressed offset, from the start of the
+        stream or the current position. Seeking from the end isn't
+        supported.
+        """
+        if self._writing:
+            raise io.UnsupportedOperation("seek")
+
+        if whence == io.SEEK_CUR:
+            offset = self._pos + offset
+        elif whence != io.SEEK_SET:
+            raise ValueError("Seeking from the end of an lzw stream is not supported")
+
+        if offset < 0:
+            raise ValueError("Negative seek position {0}".format(offset))
+
+        if offset < self._pos:
+            self._rewind(offset)
+
+        while self._pos < offset:
+            if self._offset >= len(self._buffer) and not self._fill():
+                break
+
+            count = min(offset - self._pos, len(self._buffer) - self._offset)
+            self._offset = self._offset + count
+            self._pos = self._pos + count
+
+        return self._pos
+
+
+    def close(self):
+        if self.closed:
+            return
+
+        try:
+            if self._writing:
+                if self._page_size is None:
+                    self._fileobj.write(self._packer.packchunk(self._encoder.flush()) + self._packer.flush())
+                elif self._pagefill:
+                    self._endpage()
+                    self._fileobj.write(b"".join(self._page))
+
+            if self._ownsfile:
+                self._fileobj.close()
+        finally:
+            io.RawIOBase.close(self)
+
+
+    def _fill(self):
+        # Decodes the next chunk of the underlying file into our
+        # buffer, returns False at the end of the file.
+        if self._eof:
+            return False
+
+        chunk = self._fileobj.read(self._buffersize)
+        if not chunk:
+            self._eof = True
+            return False
+
+        self._buffer = self._decoder.decodechunk(chunk)
+        self._offset = 0
+        return True
+
+
+    def _rewind(self, offset):
+        # Starts decoding over from the latest page at or before offset
+        if not self.seekable():
+            raise io.UnsupportedOperation("Can't seek backwards in an unseekable stream")
+
+        page = self._decoder.pages[0]
+        for candidate in self._decoder.pages:
+            if candidate[1] > offset:
+                break
+            page = candidate
+
+        self._fileobj.seek(self._origin + page[0])
+        self._decoder._restartat(page)
+
+        self._buffer = b""
+        self._offset = 0
+        self._pos = page[1]
+        self._eof = False
+
+
+    def _seektail(self):
+        # Readies us to append pages to the end of the paged stream
+        # in our file.
+        try:
+            (tail, headed) = _pagedtail(self._fileobj, self._buffersize)
+        except ValueError:
+            if self._ownsfile:
+                self._fileobj.close()
+            raise
+
+        self._fileobj.seek(tail)
+        self._fileobj.truncate()
+        if headed is not None:
+            self._checksums = headed
+
+
+    def _endpage(self):
+        # Finishes the current page. With checksums, whole pages are
+        # held back until they're finished, and written with a header.
+        self._page.append(self._packer.packchunk(list(self._encoder.flush()) + [ END_OF_INFO_CODE ]))
+
+        if self._checksums:
+            packed = b"".join(self._page)
+            header = struct.pack(_PAGE_HEADER, PAGE_MARKER, len(packed),
+                                 self._pagecrc & 0xFFFFFFFF, zlib.crc32(packed) & 0xFFFFFFFF)
+            self._fileobj.write(header + packed)
+            self._page = []
+
+        self._pagefill = 0
+        self._pagecrc = 0
+
+
+
+def _isseekable(fileobj):
+    # Python 2 file objects have no seekable(), so try a tell() on
+    # those instead
+    seekable = getattr(fileobj, "seekable", None)
+    if seekable is not None:
+        return seekable()
+
+    try:
+        fileobj.tell()
+    except (IOError, OSError):
+        return False
+    return True
+
+
+
+def _pagedtail(fileobj, buffersize=DEFAULT_CHUNK_SIZE):
+    # Finds the end of the last complete page of the paged stream in
+    # fileobj, from its current position on. Returns that offset, and
+    # whether the pages have checksum headers (None when there are no
+    # pages at all). Headed pages are hopped over by their lengths,
+    # and the last one checked against its checksum; otherwise we
+    # have to unpack the whole stream, looking for END_OF_INFO_CODEs.
+    origin = fileobj.tell()
+    fileobj.seek(0, io.SEEK_END)
+    size = fileobj.tell() - origin
+    fileobj.seek(origin)
+
+    first = fileobj.read(1)
+    if not first:
+        return (origin, None)
+
+    if six.byte2int(first) == PAGE_MARKER:
+        (offset, last) = (0, None)
+        while offset + _PAGE_HEADER_SIZE <= size:
+            fileobj.seek(origin + offset)
+            (marker, length, crc, packedcrc) = struct.unpack(_PAGE_HEADER, fileobj.read(_PAGE_HEADER_SIZE))
+            if marker != PAGE_MARKER:
+                raise ValueError("Page at offset {0} has no checksums".format(offset))
+            if offset + _PAGE_HEADER_SIZE + length > size:
+                break
+
+            last = (offset, length, packedcrc)
+            offset = offset + _PAGE_HEADER_SIZE + length
+
+        if last is not None:
+            fileobj.seek(origin + last[0] + _PAGE_HEADER_SIZE)
+            if zlib.crc32(fileobj.read(last[1])) & 0xFFFFFFFF != last[2]:
+                offset = last[0]
+
+        return (origin + offset, True)
+
+    if six.byte2int(first) == PRESET_MARKER:
+        raise ValueError("Streams with preset dictionaries aren't paged")
+
+    fileobj.seek(origin)
+    unpacker = BitUnpacker(initial_code_size=len(_INITIAL_CODEPOINTS))
+    (base, tail) = (0, 0)
+    while 1:
+        chunk = bytearray(fileobj.read(buffersize))
+        if not chunk:
+            break
+
+        start = 0
+        while start < len(chunk):
+            (codepoints, start) = unpacker.unpackpage(chunk, start)
+            if codepoints and codepoints[-1] == END_OF_INFO_CODE:
+                tail = base + start
+
+        base = base + len(chunk)
+
+    if not tail:
+        raise ValueError("Stream has no complete pages, and may not be paged")
+
+    return (origin + tail, False)
+
+
+
+class BitPacker(object):
+    """
+    Translates a stream of lzw codepoints into a variable width packed
+    stream of bytes, for use by L{BitUnpacker}.  One of a (potential)
+    set of encoders for a stream of LZW codepoints, intended to behave
+    as closely to the TIFF variable-width encoding as possible.
+
+    The inbound stream of integer lzw codepoints are packed into
+    variable width bit fields, starting at the smallest number of bits
+    it can and then increasing the bit width as it anticipates the LZW
+    code size growing to overflow.
+
+    This class knows all kinds of intimate things about how it's
+    upstream codepoint processors work; it knows the control codes
+    CLEAR_CODE and END_OF_INFO_CODE, and (more intimately still), it
+    makes assumptions about the rate of growth of it's consumer's
+    codebook. This is ok, as long as the underlying encoder/decoders
+    don't know any intimate details about their BitPackers/Unpackers
+    """
+
+    def __init__(self, initial_code_size, early_change=1, max_width=None):
+       """
+       Takes an initial code book size (that is, the count of known
+       codes at the beginning of encoding, or after a clear).
+
+       early_change is PDF's EarlyChange: 1 (TIFF's behavior, and
+       ours) widens codes one code before the codebook outgrows them,
+       0 as it does. If max_width is given, codes never grow past it.
+       """
+       self._initial_code_size = initial_code_size
+       self._lag = 1 - early_change
+       self._maxwidth = max_width or 64
+       self.reset()
+
+
+    def pack(self, codepoints):
+        """
+        Given an iterator of integer codepoints, returns an iterator
+        over bytes containing the codepoints packed into varying
+        lengths, with bit width growing to accomodate an input code
+        that it assumes will grow by one entry per codepoint seen.
+
+        Widths will be reset to the given initial_code_size when the
+        LZW CLEAR_CODE or END_OF_INFO_CODE code appears in the input,
+        and bytes following END_OF_INFO_CODE will be aligned to the
+        next byte boundary.
+
+        >>> import lzw, six
+        >>> pkr = lzw.BitPacker(258)
+        >>> [ b for b in pkr.pack([ 1, 257]) ] == [ six.int2byte(0), six.int2byte(0xC0), six.int2byte(0x40) ]
+        True
+        """
+        # Our bits are our own, not the packer's, so any number of
+        # these can run at once, alongside packchunk
+        state = self._startstate()
+        for pt in codepoints:
+            (packed, state) = self._pack((pt,), state)
+            for bt in six.iterbytes(packed):
+                yield six.int2byte(bt)
+
+        (bits, nbits) = state[:2]
+        if nbits:
+            yield struct.pack("B", (bits << (8 - nbits)) & 0xFF)
+
+
+    def packchunk(self, codepoints):
+        """
+        Given an iterable of integer codepoints, returns a byte string
+        holding every complete byte they pack into. Leftover bits are
+        kept to be packed ahead of the next chunk, or padded out by
+        L{flush}.
+
+        >>> import lzw
+        >>> pkr = lzw.BitPacker(258)
+        >>> pkr.packchunk([ 1 ]) == b"\\x00"
+        True
+        >>> pkr.packchunk([ 257 ]) + pkr.flush() == b"\\xC0\\x40"
+        True
+        """
+        (packed, state) = self._pack(codepoints, (self._bits, self._nbits, self._codesize, self._width))
+        (self._bits, self._nbits, self._codesize, self._width) = state
+        return packed
+
+
+    def _pack(self, codepoints, state):
+        # Packs codepoints on from state, the (bits, bit count,
+        # codesize, width) left by the codepoints before them, and
+        # returns the complete bytes and the state after them.
+        initial = self._initial_code_size
+        lag = self._lag
+        maxwidth = self._maxwidth
+        minwidth = self._minwidth
+        (bits, nbits, codesize, width) = state
+
+        packed = bytearray()
+
+        for pt in codepoints:
+            bits = (bits << width) | pt
+            nbits = nbits + width
+
+            # PAY ATTENTION. This calculation should be driven by the
+            # size of the upstream codebook, right now we're just trusting
+            # that everybody intends to follow the TIFF spec.
+            codesize = codesize + 1
+
+            if pt == CLEAR_CODE or pt == END_OF_INFO_CODE:
+                if pt == END_OF_INFO_CODE:
+                    padding = (8 - nbits % 8) % 8
+                    bits = bits << padding
+                    nbits = nbits + padding
+
+                width = minwidth
+                codesize = initial
+            elif codesize - lag >= (1 << width) and width < maxwidth:
+                width = width + 1
+
+            while nbits >= 8:
+                nbits = nbits - 8
+                packed.append((bits >> nbits) & 0xFF)
+
+            bits = bits & ((1 << nbits) - 1)
+
+        return (bytes(packed), (bits, nbits, codesize, width))
+
+
+    def flush(self):
+        """
+        Returns any bits left over from L{packchunk}, zero-padded out
+        to a whole byte, and starts the packer over, ready for a new
+        stream.
+        """
+        tail = b""
+        if self._nbits:
+            tail = struct.pack("B", (self._bits << (8 - self._nbits)) & 0xFF)
+
+        self.reset()
+        return tail
+
+
+    def reset(self):
+        """
+        Forgets any pending bits, and returns the width to its
+        starting value, so the packer can start on a new stream.
+        """
+        minwidth = 8
+        while (1 << minwidth) < self._initial_code_size:
+            minwidth = minwidth + 1
+
+        self._minwidth = minwidth
+        (self._bits, self._nbits, self._codesize, self._width) = self._startstate()
+
+
+    def _startstate(self):
+        return (0, 0, self._initial_code_size, self._minwidth)
+
+                
+
+
+class BitUnpacker(object):
+    """
+    An adaptive-width bit unpacker, intended to decode streams written
+    by L{BitPacker} into integer codepoints. Like L{BitPacker}, knows
+    about code size changes and control codes.
+    """
+
+    def __init__(self, initial_code_size, early_change=1, max_width=None):
+       """
+       initial_code_size is the starting size of the codebook
+       associated with the to-be-unpacked stream. early_change and
+       max_width are as for L{BitPacker}.
+       """
+       self._initial_code_size = initial_code_size
+       self._lag = 1 - early_change
+       self._maxwidth = max_width or 64
+       self.reset()
+
+
+    def unpack(self, bytesource):
+        """
+        Given an iterator of bytes, returns an iterator of integer
+        code points. Auto-magically adjusts point width when it sees
+        an almost-overflow in the input stream, or an LZW CLEAR_CODE
+        or END_OF_INFO_CODE
+
+        Trailing bits at the end of the given iterator, after the last
+        codepoint, will be dropped on the floor.
+
+        At the end of the iteration, or when an END_OF_INFO_CODE seen
+        the unpacker will ignore the bits after the code until it
+        reaches the next aligned byte. END_OF_INFO_CODE will *not*
+        stop the generator, just reset the alignment and the width
+
+
+        >>> import lzw, six
+        >>> unpk = lzw.BitUnpacker(initial_code_size=258)
+        >>> [ i for i in unpk.unpack([ six.int2byte(0), six.int2byte(0xC0), six.int2byte(0x40) ]) ]
+        [1, 257]
+        """
+        state = self._startstate()
+        for piece in _bytepieces(bytesource):
+            (codepoints, end, state) = self._unpack(piece, 0, False, state)
+            for codepoint in codepoints:
+                yield codepoint
+
+
+    def unpackchunk(self, data):
+        """
+        Given a bytes-like chunk of a packed stream, returns a list of
+        the codepoints it completes. Bits left over at the end of the
+        chunk are kept, and finish a codepoint on the next call, so a
+        stream can be unpacked a chunk at a time as it arrives.
+
+        >>> import lzw
+        >>> unpk = lzw.BitUnpacker(initial_code_size=258)
+        >>> unpk.unpackchunk(b"\\x00")
+        []
+        >>> unpk.unpackchunk(b"\\xC0\\x40")
+        [1, 257]
+        """
+        return self._unpackchunk(data, 0, False)[0]
+
+
+    def unpackpage(self, data, start=0):
+        """
+        Like L{unpackchunk}, but unpacks data from index start on, and
+        stops just after the first END_OF_INFO_CODE (which will end
+        the returned list of codepoints). Returns the codepoints and
+        the index in data just past the last byte used.
+
+        >>> import lzw
+        >>> unpk = lzw.BitUnpacker(initial_code_size=258)
+        >>> unpk.unpackpage(b"\\x00\\xC0\\x40\\x00\\xC0")
+        ([1, 257], 3)
+        >>> unpk.unpackpage(b"\\x00\\xC0\\x40\\x00\\xC0", 3)
+        ([1], 5)
+        """
+        return self._unpackchunk(data, start, True)
+
+
+    def _unpackchunk(self, data, start, stoponeoi):
+        if not isinstance(data, bytearray):
+            data = bytearray(data)
+
+        (codepoints, end, state) = self._unpack(data, start, stoponeoi,
+                                                (self._bits, self._nbits, self._codesize, self._width))
+        (self._bits, self._nbits, self._codesize, self._width) = state
+        return (codepoints, end)
+
+
+    def _unpack(self, data, start, stoponeoi, state):
+        # Unpacks the bytearray data from index start on, from state,
+        # as for BitPacker._pack, returning the codepoints, the index
+        # just past the last byte used and the state after them.
+        initial = self._initial_code_size
+        lag = self._lag
+        maxwidth = self._maxwidth
+        minwidth = self._minwidth
+        (bits, nbits, codesize, width) = state
+
+        codepoints = []
+        end = len(data)
+
+        for (index, value) in enumerate(itertools.islice(data, start, None), start):
+            bits = (bits << 8) | value
+            nbits = nbits + 8
+
+            while nbits >= width:
+                nbits = nbits - width
+                codepoint = bits >> nbits
+                bits = bits & ((1 << nbits) - 1)
+
+                codepoints.append(codepoint)
+                codesize = codesize + 1
+
+                if codepoint == CLEAR_CODE or codepoint == END_OF_INFO_CODE:
+                    codesize = initial
+                    width = minwidth
+
+                    if codepoint == END_OF_INFO_CODE:
+                        # Skip ahead to the next byte boundary
+                        nbits = nbits - (nbits % 8)
+                        bits = bits & ((1 << nbits) - 1)
+                else:
+                    while codesize - lag >= (1 << width) and width < maxwidth:
+                        width = width + 1
+
+            if stoponeoi and codepoints and codepoints[-1] == END_OF_INFO_CODE:
+                end = index + 1
+                break
+
+        return (codepoints, end, (bits, nbits, codesize, width))
+
+
+    def reset(self):
+        """
+        Forgets any partially unpacked codepoint, and returns the
+        width to its starting value, so the unpacker can start on a
+        new stream.
+        """
+        minwidth = 8
+        while (1 << minwidth) < self._initial_code_size:
+            minwidth = minwidth + 1
+
+        self._minwidth = minwidth
+        (self._bits, self._nbits, self._codesize, self._width) = self._startstate()
+
+
+    def _startstate(self):
+        return (0, 0, self._initial_code_size, self._minwidth)
+
+
+
+class Decoder(object):
+    """
+    Uncompresses a stream of lzw code points, as created by
+    L{Encoder}. Given a list of integer code points, with all
+    unpacking foolishness complete, turns that list of codepoints into
+    a list of uncompressed bytes. See L{BitUnpacker} for what this
+    doesn't do.
+    """
+    def __init__(self, preset=None):
+       """
+       Creates a new Decoder. Decoders should not be reused for
+       different streams without a call to L{reset}. If preset is
+       given, it should be the L{PresetDictionary} the stream was
+       encoded with.
+       """
+       if preset is None:
+           self._initial_codepoints = _INITIAL_CODEPOINTS
+       else:
+           self._initial_codepoints = preset._codepoints
+
+       self._clear_codes()
+       self.remainder = []
+
+
+    def code_size(self):
+       """
+       Returns the current size of the Decoder's code book, that is,
+       it's mapping of codepoints to byte strings. The return value of
+       this method will change as the decode encounters more encoded
+       input, or control codes.
+       """
+       return len(self._codepoints)
+
+
+    def decode(self, codepoints):
+        """
+        Given an iterable of integer codepoints, yields the
+        corresponding bytes, one at a time, as byte strings of length
+        E{1}. Retains the state of the codebook from call to call, so
+        if you have another stream, you'll likely need another
+        decoder!
+
+        Decoders will NOT handle END_OF_INFO_CODE (rather, they will
+        handle the code by throwing an exception); END_OF_INFO should
+        be handled by the upstream codepoint generator (see
+        L{BitUnpacker}, for example)
+
+        >>> import lzw
+        >>> dec = lzw.Decoder()
+        >>> result = b''.join(dec.decode([103, 97, 98, 98, 97, 32, 258, 260, 262, 121, 111, 263, 259, 261, 256]))
+        >>> result == b'gabba gabba yo gabba'
+        True
+
+        Raises an L{InvalidCodeError} at the first codepoint that's
+        neither in the codebook nor the next code to be added to it.
+
+        >>> b''.join(lzw.Decoder().decode([103, 97, 300])) # doctest: +IGNORE_EXCEPTION_DETAIL
+        Traceback (most recent call last):
+        ...
+        InvalidCodeError: Code 300 is beyond the codebook (size 259)
+        """
+        for decoded in self.decodestrings(codepoints):
+            for i in range(len(decoded)):
+                yield decoded[i:i + 1]
+
+
+
+    def decodestrings(self, codepoints):
+        """
+        Like L{decode}, but yields the byte string for each codepoint
+        whole, rather than one byte at a time. Codepoints that decode
+        to nothing (CLEAR_CODE) yield nothing.
+
+        >>> import lzw
+        >>> dec = lzw.Decoder()
+        >>> [ s for s in dec.decodestrings([103, 97, 98, 258, 256]) ] == [ b"g", b"a", b"b", b"ga" ]
+        True
+        """
+        for cp in codepoints:
+            decoded = self._decode_codepoint(cp)
+            if decoded:
+                yield decoded
+
+
+    def _decode_codepoint(self, codepoint):
+        """
+        Will raise a ValueError if given an END_OF_INFORMATION
+        code. EOI codes should be handled by callers if they're
+        present in our source stream.
+
+        >>> import lzw
+        >>> dec = lzw.Decoder()
+        >>> beforesize = dec.code_size()
+        >>> dec._decode_codepoint(0x80) == b'\\x80'
+        True
+        >>> dec._decode_codepoint(0x81) == b'\\x81'
+        True
+        >>> beforesize + 1 == dec.code_size()
+        True
+        >>> dec._decode_codepoint(256) == b''
+        True
+        >>> beforesize == dec.code_size()
+        True
+        """
+
+        ret = b""
+
+        if codepoint == CLEAR_CODE:
+            self._clear_codes()
+        elif codepoint == END_OF_INFO_CODE:
+            raise ValueError("End of information code not supported directly by this Decoder")
+        else:
+            if codepoint in self._codepoints:
+                ret = self._codepoints[ codepoint ]
+                if None != self._prefix:
+                    self._codepoints[ len(self._codepoints) ] = self._prefix + ret[:1]
+
+            elif codepoint == len(self._codepoints) and self._prefix is not None:
+                ret = self._prefix + self._prefix[:1]
+                self._codepoints[ len(self._codepoints) ] = ret
+            else:
+                raise InvalidCodeError("Code {0} is beyond the codebook (size {1})".format(codepoint, len(self._codepoints)))
+
+            self._prefix = ret
+
+        return ret
+
+
+    def reset(self):
+        """
+        Readies the Decoder for a new stream, clearing its codebook.
+        """
+        self._clear_codes()
+
+
+    def _clear_codes(self):
+        self._codepoints = dict(self._initial_codepoints)
+        self._prefix = None
+
+
+class Encoder(object):
+    """
+    Given an iterator of bytes, returns an iterator of integer
+    codepoints, suitable for use by L{Decoder}. The core of the
+    "compression" side of lzw compression/decompression.
+    """
+    def __init__(self, max_code_size=(2**DEFAULT_MAX_BITS), preset=None):
+        """
+        When the encoding codebook grows larger than max_code_size,
+        the Encoder will clear its codebook and emit a CLEAR_CODE.
+        If preset is given, it should be a L{PresetDictionary}, and
+        the codebook will start from (and clear back to) its entries.
+        """
+
+        self.closed = False
+
+        if preset is None:
+            self._initial_prefixes = _INITIAL_PREFIXES
+        else:
+            self._initial_prefixes = preset._prefixes
+
+        self._max_code_size = max_code_size
+        self._buffer = b''
+        self._clear_codes()            
+
+        if max_code_size < self.code_size():
+            raise ValueError("Max code size too small, (must be at least {0})".format(self.code_size()))
+
+
+    def code_size(self):
+        """
+        Returns a count of the known codes, including codes that are
+        implicit in the data but have not yet been produced by the
+        iterator.
+        """
+        return len(self._prefixes)
+
+
+    def flush(self, endcode=CLEAR_CODE):
+        """
+        Yields any buffered codepoints, followed by endcode (a
+        CLEAR_CODE, or the END_OF_INFO_CODE that ends a PDF stream),
+        and clears the codebook as a side effect.
+        """
+
+        if self._buffer:
+            yield self._prefixes[ self._buffer ]
+            self._buffer = b''
+
+        yield endcode
+        self._clear_codes()
+
+            
+
+
+    def encode(self, bytesource):
+        """
+        Given an iterator over bytes, yields the
+        corresponding stream of codepoints.
+        Will clear the codes at the end of the stream.
+
+        >>> import lzw
+        >>> enc = lzw.Encoder()
+        >>> [ cp for cp in enc.encode(b"gabba gabba yo gabba") ]
+        [103, 97, 98, 98, 97, 32, 258, 260, 262, 121, 111, 263, 259, 261, 256]
+
+        """
+        for piece in _bytepieces(bytesource):
+            for point in self._encodevalues(piece):
+                yield point
+        
+        for point in self.flush():
+            yield point
+
+
+    def encodechunk(self, data):
+        """
+        Given a bytes-like chunk of input, returns a list of the
+        codepoints it completes. Unlike L{encode}, doesn't flush at
+        the end of the chunk, the prefix matched so far carries over
+        into the next call. Call L{flush} at the end of the stream.
+
+        >>> import lzw
+        >>> enc = lzw.Encoder()
+        >>> enc.encodechunk(b"gabba ")
+        [103, 97, 98, 98, 97]
+        >>> enc.encodechunk(b"gabba yo gabba") + list(enc.flush())
+        [32, 258, 260, 262, 121, 111, 263, 259, 261, 256]
+        """
+        if not isinstance(data, bytearray):
+            data = bytearray(data)
+
+        # Same as _encodevalues, minus the generator and with each
+        # prefix's code kept at hand, since this is the hot loop.
+        prefixes = self._prefixes
+        lookup = prefixes.get
+        prefix = self._buffer
+        prefixcode = lookup(prefix)
+        nextcode = len(prefixes)
+        max_code_size = self._max_code_size
+
+        codepoints = []
+        emit = codepoints.append
+
+        for value in data:
+            byte = _BYTES[ value ]
+            extended = prefix + byte
+            code = lookup(extended)
+
+            if code is not None:
+                prefix = extended
+                prefixcode = code
+            else:
+                emit(prefixcode)
+                prefixes[ extended ] = nextcode
+                nextcode = nextcode + 1
+                prefix = byte
+                prefixcode = value
+
+                if nextcode >= max_code_size:
+                    self._buffer = prefix
+                    codepoints.extend(self.flush())
+                    prefixes = self._prefixes
+                    lookup = prefixes.get
+                    prefix = self._buffer
+                    prefixcode = None
+                    nextcode = len(prefixes)
+
+        self._buffer = prefix
+
+        return codepoints
+
+
+    def _encodevalues(self, values):
+        # Yields codepoints for an iterable of integer byte values,
+        # changing the codebook and prefix buffer as it goes. Every
+        # codepoint is added to the codebook before it's yielded.
+        prefixes = self._prefixes
+        prefix = self._buffer
+        max_code_size = self._max_code_size
+
+        for value in values:
+            byte = _BYTES[ value ]
+            extended = prefix + byte
+
+            if extended in prefixes:
+                prefix = extended
+            else:
+                encoded = prefixes[ prefix ]
+                prefixes[ extended ] = len(prefixes)
+                prefix = byte
+                self._buffer = prefix
+
+                yield encoded
+
+                if len(prefixes) >= max_code_size:
+                    for pt in self.flush():
+                        yield pt
+
+                    prefixes = self._prefixes
+                    prefix = self._buffer
+
+        self._buffer = prefix
+
+
+    def reset(self):
+        """
+        Readies the Encoder for a new stream, dropping any buffered
+        prefix (without emitting it, unlike L{flush}) and clearing its
+        codebook.
+        """
+        self._buffer = b''
+        self._clear_codes()
+
+
+    def _clear_codes(self):
+        self._prefixes = dict(self._initial_prefixes)
+
+
+
+class FlexibleEncoder(Encoder):
+    """
+    An L{Encoder} that doesn't always emit the longest match it has.
+    Before each code, it looks lookahead codes further on, and picks
+    the match (of the longest one's prefixes) that lets the codes
+    after it reach furthest into the input, ties going to the longer
+    match. That usually means fewer codes for the same input, at the
+    price of a good deal more work per code, growing quickly with
+    lookahead.
+
+    The codebook grows just as the plain Encoder's does, one entry
+    for every code, so the output decodes with an ordinary
+    L{Decoder}. Since the entry added after a shorter match may
+    already be in the codebook, the encoder keeps its own count of
+    the codes handed out, duplicates and all.
+
+    >>> import lzw
+    >>> text = b"abcabcabcdabcdabcde" * 3
+    >>> codepoints = list(lzw.FlexibleEncoder(lookahead=1).encode(text))
+    >>> len(list(lzw.Encoder().encode(text))), len(codepoints)
+    (24, 23)
+    >>> b"".join(lzw.Decoder().decode(codepoints)) == text
+    True
+    """
+
+    def __init__(self, max_code_size=(2**DEFAULT_MAX_BITS), preset=None, lookahead=1):
+        """
+        max_code_size and preset are as for L{Encoder}. lookahead is
+        how many codes past the next one to look at, 1 or 2 are
+        sensible.
+        """
+        self.lookahead = lookahead
+        self._pending = bytearray()
+        Encoder.__init__(self, max_code_size=max_code_size, preset=preset)
+
+
+    def code_size(self):
+        return self._nextcode
+
+
+    def encode(self, bytesource):
+        """
+        Given an iterator over bytes, yields the corresponding stream
+        of codepoints, clearing the codes at the end of the stream.
+        """
+        for piece in _bytepieces(bytesource):
+            for point in self.encodechunk(piece):
+                yield point
+
+        for point in self.flush():
+            yield point
+
+
+    def encodechunk(self, data):
+        """
+        Like L{Encoder.encodechunk}. The last few hundred bytes of
+        input are held back, to look ahead into, until there's more
+        input or a L{flush}.
+        """
+        self._pending.extend(data)
+        return self._parse(_LOOKAHEAD_MARGIN)
+
+
+    def flush(self, endcode=CLEAR_CODE):
+        """
+        Yields the codepoints for any input held back, followed by
+        endcode, and clears the codebook.
+        """
+        for point in self._parse(0):
+            yield point
+
+        yield endcode
+        self._clear_codes()
+
+
+    def reset(self):
+        self._pending = bytearray()
+        Encoder.reset(self)
+
+
+    def _clear_codes(self):
+        Encoder._clear_codes(self)
+        self._nextcode = len(self._prefixes)
+
+
+    def _parse(self, margin):
+        # Emits codes for the pending input, up to margin bytes from
+        # its end, or all of it when margin is 0.
+        data = bytes(self._pending)
+        prefixes = self._prefixes
+        codepoints = []
+        start = 0
+
+        while start < len(data) - margin:
+            longest = self._longest(data, start)
+            if margin and start + longest >= len(data):
+                break
+
+            # A shorter match whose codebook entry would be a duplicate
+            # wastes a code, so counts as reaching a byte less.
+            length = longest
+            if self.lookahead > 0 and longest > 1:
+                reach = -1
+                for candidate in range(longest, 0, -1):
+                    candidatereach = self._reach(data, start + candidate, self.lookahead - 1)
+                    if candidate < longest and data[start:start + candidate + 1] in prefixes:
+                        candidatereach = candidatereach - 1
+                    if candidatereach > reach:
+                        (length, reach) = (candidate, candidatereach)
+
+            codepoints.append(prefixes[ data[start:start + length] ])
+            start = start + length
+
+            if start < len(data):
+                entry = data[start - length:start + 1]
+                if entry not in prefixes:
+                    prefixes[ entry ] = self._nextcode
+                self._nextcode = self._nextcode + 1
+
+                if self._nextcode >= self._max_code_size:
+                    codepoints.append(CLEAR_CODE)
+                    self._clear_codes()
+                    prefixes = self._prefixes
+
+        del self._pending[:start]
+        return codepoints
+
+
+    def _longest(self, data, start):
+        # The length of the longest codebook entry at start in data
+        prefixes = self._prefixes
+        end = start + 1
+        while end < len(data) and data[start:end + 1] in prefixes:
+            end = end + 1
+
+        return end - start
+
+
+    def _reach(self, data, start, depth):
+        # How far into data the next depth + 1 codes from start can get
+        if start >= len(data):
+            return start
+
+        longest = self._longest(data, start)
+        if depth == 0:
+            return start + longest
+
+        return max(self._reach(data, start + length, depth - 1) for length in range(longest, 0, -1))
+
+
+
+class PagingEncoder(object):
+    """
+    Handles encoding of multiple chunks or streams of encodable data,
+    separated with control codes. Dual of PagingDecoder.
+
+    With checksums, every page is preceded by a header holding
+    PAGE_MARKER, the length of the compressed page, and CRC32s of
+    the uncompressed and compressed page, so pages can be found and
+    checked (see L{verifypages}) without decoding anything.
+    """
+    def __init__(self, initial_code_size, max_code_size, checksums=False):
+        self._initial_code_size = initial_code_size
+        self._max_code_size = max_code_size
+        self._checksums = checksums
+
+        (self._encoder, self._packer) = self._codecs()
+
+
+    def encodepages(self, pages):
+        """
+        Given an iterator of iterators of bytes, produces a single
+        iterator containing a delimited sequence of independantly
+        compressed LZW sequences, all beginning on a byte-aligned
+        spot, all beginning with a CLEAR code and all terminated with
+        an END_OF_INFORMATION code (and zero to seven trailing junk
+        bits.)
+
+        The dual of PagingDecoder.decodepages
+
+        >>> import lzw
+        >>> enc = lzw.PagingEncoder(257, 2**12)
+        >>> coded = enc.encodepages([ b"say hammer yo hammer mc hammer go hammer", 
+        ...                           b"and the rest can go and play",
+        ...                           b"can't touch this" ])
+        ...
+        >>> result = b"".join(coded)
+        >>> result == b'\\x80\\x1c\\xcc\\'\\x91\\x01\\xa0\\xc2m6\\x99NB\\x03\\xc9\\xbe\\x0b\\x07\\x84\\xc2\\xcd\\xa68|"\\x14 3\\xc3\\xa0\\xd1c\\x94\\x02\\x02\\x80\\x18M\\xc6A\\x01\\xd0\\xd0e\\x10\\x1c\\x8c\\xa73\\xa0\\x80\\xc7\\x02\\x10\\x19\\xcd\\xe2\\x08\\x14\\x10\\xe0l0\\x9e`\\x10\\x10\\x80\\x18\\xcc&\\xe19\\xd0@t7\\x9dLf\\x889\\xa0\\xd2s\\x80@@'
+        True
+
+        """
+        # Each generator has its own codecs, so any number of them can
+        # run at once
+        codecs = self._codecs()
+        for page in pages:
+            for bt in six.iterbytes(self._encodepage(page, *codecs)):
+                yield six.int2byte(bt)
+
+
+    def encodedpages(self, pages, workers=None):
+        """
+        Like L{encodepages}, but yields each compressed page whole, as
+        a byte string. If workers is more than one, pages (which
+        should be byte strings) are compressed by a pool of that many
+        processes, a few pages per worker at a time, so memory use
+        doesn't grow with the length of pages.
+
+        >>> import lzw
+        >>> enc = lzw.PagingEncoder(258, 2**12)
+        >>> [ len(page) for page in enc.encodedpages([ b"say hammer", b"yo hammer" ]) ]
+        [15, 14]
+        """
+        if not workers or workers < 2:
+            codecs = self._codecs()
+            for page in pages:
+                yield self._encodepage(page, *codecs)
+            return
+
+        settings = (self._initial_code_size, self._max_code_size, self._checksums)
+        pages = iter(pages)
+
+        pool = multiprocessing.Pool(workers)
+        try:
+            pending = None
+            while 1:
+                window = [ settings + (page,) for page in itertools.islice(pages, workers * 4) ]
+                submitted = None
+                if window:
+                    submitted = pool.map_async(_encodepage_worker, window)
+
+                if pending is not None:
+                    for packed in pending.get():
+                        yield packed
+
+                if submitted is None:
+                    break
+
+                pending = submitted
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+    def encodepage(self, page):
+        """
+        Returns a single compressed page, as a byte string, headed
+        with its checksums if we're keeping them. Uses codecs kept on
+        the PagingEncoder, so calls shouldn't overlap (from several
+        threads, say).
+        """
+        return self._encodepage(page, self._encoder, self._packer)
+
+
+    def _codecs(self):
+        encoder = Encoder(max_code_size=self._max_code_size)
+        return (encoder, BitPacker(initial_code_size=encoder.code_size()))
+
+
+    def _encodepage(self, page, encoder, packer):
+        encoder.reset()
+        packer.reset()
+
+        packed = [ packer.packchunk([ CLEAR_CODE ]) ]
+        crc = 0
+        for chunk in _bytechunks(page):
+            crc = zlib.crc32(bytes(chunk), crc)
+            packed.append(packer.packchunk(encoder.encodechunk(chunk)))
+
+        packed.append(packer.packchunk(list(encoder.flush()) + [ END_OF_INFO_CODE ]))
+        packed = b"".join(packed)
+
+        if not self._checksums:
+            return packed
+
+        header = struct.pack(_PAGE_HEADER, PAGE_MARKER, len(packed),
+                             crc & 0xFFFFFFFF, zlib.crc32(packed) & 0xFFFFFFFF)
+        return header + packed
+
+
+            
+
+def _encodepage_worker(arguments):
+    (initial_code_size, max_code_size, checksums, page) = arguments
+    return PagingEncoder(initial_code_size, max_code_size, checksums=checksums).encodepage(page)
+
+
+
+class PagingDecoder(object):
+    """
+    Dual of PagingEncoder, knows how to handle independantly encoded,
+    END_OF_INFO_CODE delimited chunks of an inbound byte stream.
+    Checks the checksums of pages that have them.
+    """
+
+    def __init__(self, initial_code_size):
+        """
+        initial_code_size is kept for compatibility: code widths
+        follow the size of a fresh L{Decoder}'s codebook, just as
+        L{PagingEncoder}'s follow its L{Encoder}'s.
+        """
+        self._initial_code_size = initial_code_size
+        self._remains = []
+
+    def next_page(self, codepoints):
+        """
+        Iterator over the next page of codepoints.
+        """
+        self._remains = []
+
+        try:
+            while 1:
+                cp = six.next(codepoints)
+                if cp != END_OF_INFO_CODE:
+                    yield cp
+                else:
+                    self._remains = codepoints
+                    break
+
+        except StopIteration:
+            pass
+        
+
+    def decodepages(self, bytesource):
+        """
+        Takes an iterator of bytes, returns an iterator of iterators
+        of uncompressed data. Expects input to conform to the output
+        conventions of PagingEncoder(), in particular that "pages" are
+        separated with an END_OF_INFO_CODE and padding up to the next
+        byte boundary. Raises a L{ChecksumError} on a page that
+        doesn't match its checksums.
+
+        BUG: Dangling trailing page on decompression.
+
+        >>> import lzw
+        >>> pgdec = lzw.PagingDecoder(initial_code_size=257)
+        >>> pgdecoded = pgdec.decodepages(
+        ...     b''.join([b'\\x80\\x1c\\xcc\\'\\x91\\x01\\xa0\\xc2m6',
+        ...               b'\\x99NB\\x03\\xc9\\xbe\\x0b\\x07\\x84\\xc2',
+        ...               b'\\xcd\\xa68|"\\x14 3\\xc3\\xa0\\xd1c\\x94',
+        ...               b'\\x02\\x02\\x80\\x18M\\xc6A\\x01\\xd0\\xd0e',
+        ...               b'\\x10\\x1c\\x8c\\xa73\\xa0\\x80\\xc7\\x02\\x10',
+        ...               b'\\x19\\xcd\\xe2\\x08\\x14\\x10\\xe0l0\\x9e`\\x10',
+        ...               b'\\x10\\x80\\x18\\xcc&\\xe19\\xd0@t7\\x9dLf\\x889',
+        ...               b'\\xa0\\xd2s\\x80@@'])
+        ... )
+        >>> result = [ b"".join(pg) for pg in pgdecoded ]
+        >>> result == [b'say hammer yo hammer mc hammer go hammer', b'and the rest can go and play', b"can't touch this", b'']
+        True
+
+        >>> enc = lzw.PagingEncoder(258, 2**12, checksums=True)
+        >>> coded = b"".join(enc.encodepages([ b"say hammer", b"yo hammer" ]))
+        >>> [ b"".join(pg) for pg in pgdec.decodepages(coded) ] == [ b"say hammer", b"yo hammer", b"" ]
+        True
+        >>> damaged = coded[:-3] + b"!" + coded[-2:]
+        >>> [ b"".join(pg) for pg in pgdec.decodepages(damaged) ] # doctest: +IGNORE_EXCEPTION_DETAIL
+        Traceback (most recent call last):
+        ...
+        ChecksumError: Bad compressed checksum on page 1
+        """
+
+        # TODO: WE NEED A CODE SIZE POLICY OBJECT THAT ISN'T THIS.
+        # honestly, we should have a "codebook" object we need to pass
+        # to bit packing/unpacking tools, etc, such that we don't have
+        # to roll all of these code size assumptions everyplace.
+
+        reader = _PageReader(bytesource)
+        pagenumber = 0
+
+        decoder = Decoder()
+        unpacker = BitUnpacker(initial_code_size=decoder.code_size())
+
+        while 1:
+            (header, packed, ended) = reader.nextpage(unpacker)
+            decoded = _decodepage(decoder, unpacker, header, packed, ended, pagenumber)
+
+            yield [ decoded[i:i + 1] for i in range(len(decoded)) ]
+
+            if not ended:
+                break
+
+            pagenumber = pagenumber + 1
+
+
+
+def _decodepage(decoder, unpacker, header, packed, ended, pagenumber):
+    # Decodes a page found by a _PageReader, checking it against its
+    # header, if it has one.
+    decoder.reset()
+    unpacker.reset()
+
+    codepoints = unpacker.unpackchunk(packed)
+    if ended:
+        codepoints.pop()
+
+    decoded = b"".join(decoder.decodestrings(codepoints))
+
+    if header is not None:
+        (_, _, plaincrc, packedcrc) = header
+        if zlib.crc32(packed) & 0xFFFFFFFF != packedcrc:
+            raise ChecksumError(pagenumber, "compressed")
+        if zlib.crc32(decoded) & 0xFFFFFFFF != plaincrc:
+            raise ChecksumError(pagenumber, "uncompressed")
+
+    return decoded
+
+
+
+class _PageReader(object):
+    # Splits a paged stream into its pages, reading no further into
+    # bytesource than it has to.
+
+    def __init__(self, bytesource):
+        self._chunks = _bytechunks(bytesource)
+        self._buffer = bytearray()
+        self._offset = 0
+        self.position = 0
+
+
+    def nextpage(self, unpacker):
+        """
+        Returns the next page's header (or None), its packed bytes,
+        and whether it's complete, that is, not cut short by the end
+        of the stream. Pages without a header are found by running
+        unpacker, a fresh L{BitUnpacker}, up to END_OF_INFO_CODE.
+        """
+        first = self.read(1)
+        if first and six.indexbytes(first, 0) == PAGE_MARKER:
+            headerbytes = first + self.read(_PAGE_HEADER_SIZE - 1)
+            if len(headerbytes) < _PAGE_HEADER_SIZE:
+                return (None, b"", False)
+
+            header = struct.unpack(_PAGE_HEADER, headerbytes)
+            packed = self.read(header[1])
+            return (header, packed, len(packed) == header[1])
+
+        # No header, put the byte back and look for the page's end
+        self._offset = self._offset - len(first)
+        self.position = self.position - len(first)
+
+        packed = []
+        while self._fill():
+            (codepoints, end) = unpacker.unpackpage(self._buffer, self._offset)
+            packed.append(bytes(self._buffer[self._offset:end]))
+            self.position = self.position + (end - self._offset)
+            self._offset = end
+
+            if codepoints and codepoints[-1] == END_OF_INFO_CODE:
+                unpacker.reset()
+                return (None, b"".join(packed), True)
+
+        unpacker.reset()
+        return (None, b"".join(packed), False)
+
+
+    def read(self, count):
+        """
+        Returns the next count bytes, or fewer at the end of the
+        stream.
+        """
+        # _fill moves our offset, so only work out the slice afterwards
+        while len(self._buffer) - self._offset < count and self._fill(force=True):
+            pass
+
+        data = bytes(self._buffer[self._offset:self._offset + count])
+        self._offset = self._offset + len(data)
+        self.position = self.position + len(data)
+        return data
+
+
+    def _fill(self, force=False):
+        # Makes sure there are unread bytes in our buffer (or more of
+        # them, if force), returns False if there aren't any more.
+        if self._offset < len(self._buffer) and not force:
+            return True
+
+        del self._buffer[:self._offset]
+        self._offset = 0
+
+        for chunk in self._chunks:
+            self._buffer.extend(chunk)
+            return True
+
+        return self._offset < len(self._buffer) and not force
+
+
+
+def verifypages(data, workers=None):
+    """
+    Checks the compressed checksums of every page of a checksummed
+    paged stream (see L{PagingEncoder}), without decoding any of them,
+    and returns a list of the indexes of bad pages (a page cut short
+    by the end of data is bad). With workers, the checksums are
+    computed in a pool of that many threads. data should be a
+    bytes-like object, like a byte string or an mmap.
+
+    Raises a ValueError on pages without checksums. A leading preset
+    dictionary header is skipped.
+
+    >>> import lzw
+    >>> enc = lzw.PagingEncoder(258, 2**12, checksums=True)
+    >>> coded = b"".join(enc.encodepages([ b"say hammer", b"yo hammer" ]))
+    >>> lzw.verifypages(coded)
+    []
+    >>> lzw.verifypages(coded[:-3] + b"!" + coded[-2:], workers=2)
+    [1]
+    """
+    view = memoryview(data)
+
+    # Pages follow the stream's preset dictionary header, if any
+    pages = []
+    offset = 0
+    if view[:1].tobytes() == six.int2byte(PRESET_MARKER):
+        offset = 5
+
+    while offset < len(view):
+        header = view[offset:offset + _PAGE_HEADER_SIZE].tobytes()
+        if six.indexbytes(header, 0) != PAGE_MARKER:
+            raise ValueError("Page {0} at offset {1} has no checksums".format(len(pages), offset))
+        if len(header) < _PAGE_HEADER_SIZE:
+            pages.append((None, None))
+            break
+
+        (_, length, _, packedcrc) = struct.unpack(_PAGE_HEADER, header)
+        start = offset + _PAGE_HEADER_SIZE
+        offset = start + length
+
+        if offset > len(view):
+            pages.append((None, None))
+        else:
+            pages.append((view[start:offset].tobytes(), packedcrc))
+
+    if workers and workers > 1:
+        pool = ThreadPool(workers)
+        try:
+            good = pool.map(_checkpage, pages)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        good = [ _checkpage(page) for page in pages ]
+
+    return [ index for (index, ok) in enumerate(good) if not ok ]
+
+
+def _checkpage(page):
+    (packed, packedcrc) = page
+    return packed is not None and zlib.crc32(packed) & 0xFFFFFFFF == packedcrc
+
+
+
+class _Channel(object):
+    # A Multiplexer channel's resident coders, and how far into its
+    # current page it is: pagebegun once the page's CLEAR_CODE has
+    # been encoded, framed once a frame of the page has gone out.
+
+    def __init__(self, max_code_size):
+        self.encoder = Encoder(max_code_size=max_code_size)
+        self.packer = BitPacker(initial_code_size=self.encoder.code_size())
+        self.pagebegun = False
+        self.framed = False
+
+
+
+class Multiplexer(object):
+    """
+    Compresses many logical streams, or channels, into one, as a run
+    of frames. Each frame is CHANNEL_MARKER, a flags byte, and the
+    32 bit channel id and payload length, followed by the payload:
+    the next bytes of that channel's compressed stream. A channel's
+    stream is a run of pages, as from L{PagingEncoder}, each ended
+    when the channel is flushed, so everything written to a channel
+    before a flush can be decoded from the frames up to it. Frames
+    holding the start of a page are flagged, so a L{Demultiplexer}
+    can pick up a channel part way through the stream.
+
+    Each channel's L{Encoder} and L{BitPacker} stay resident between
+    writes, until the channel is closed.
+
+    >>> import lzw
+    >>> mux = lzw.Multiplexer()
+    >>> stream = mux.write(1, b"gabba gabba ") + mux.write(2, b"say hammer")
+    >>> stream = stream + mux.write(1, b"yo gabba") + mux.flushall()
+    >>> demux = lzw.Demultiplexer(channels=[ 1 ])
+    >>> decoded = demux.feed(stream)
+    >>> [ channel for (channel, data) in decoded ]
+    [1, 1, 1]
+    >>> b"".join(data for (channel, data) in decoded) == b"gabba gabba yo gabba"
+    True
+    """
+
+    def __init__(self, max_width=DEFAULT_MAX_BITS):
+        self._max_code_size = 2**max_width
+        self._channels = {}
+
+
+    def write(self, channel, data):
+        """
+        Compresses the bytes-like data onto channel, returning a frame
+        of whatever compressed bytes it completes (or an empty byte
+        string, if there aren't any yet.)
+        """
+        state = self._channels.get(channel)
+        if state is None:
+            state = _Channel(self._max_code_size)
+            self._channels[ channel ] = state
+
+        codepoints = state.encoder.encodechunk(data)
+        if data and not state.pagebegun:
+            codepoints.insert(0, CLEAR_CODE)
+            state.pagebegun = True
+
+        return self._frame(channel, state, state.packer.packchunk(codepoints))
+
+
+    def flush(self, channel):
+        """
+        Ends the channel's page in progress, returning a frame of the
+        rest of its bytes.
+        """
+        state = self._channels.get(channel)
+        if state is None or not state.pagebegun:
+            return b""
+
+        packed = state.packer.packchunk(list(state.encoder.flush()) + [ END_OF_INFO_CODE ])
+        frame = self._frame(channel, state, packed)
+
+        state.pagebegun = False
+        state.framed = False
+        return frame
+
+
+    def flushall(self):
+        """
+        Flushes every channel, returning their frames.
+        """
+        return b"".join(self.flush(channel) for channel in sorted(self._channels))
+
+
+    def close(self, channel):
+        """
+        Flushes the channel, and forgets it, returning its last frames,
+        the last flagged as the channel's end.
+        """
+        frame = self.flush(channel)
+        self._channels.pop(channel, None)
+
+        return frame + struct.pack(_FRAME_HEADER, CHANNEL_MARKER, _FRAME_END, channel, 0)
+
+
+    def _frame(self, channel, state, packed):
+        if not packed:
+            return b""
+
+        flags = 0
+        if not state.framed:
+            flags = _FRAME_PAGESTART
+            state.framed = True
+
+        return struct.pack(_FRAME_HEADER, CHANNEL_MARKER, flags, channel, len(packed)) + packed
+
+
+
+class Demultiplexer(object):
+    """
+    Decodes the channels of a L{Multiplexer}'s stream. Only channels
+    that have been subscribed to are decoded, the frames of the rest
+    are skipped over. A channel subscribed to part way through the
+    stream is decoded from the start of its next page on.
+    """
+
+    def __init__(self, channels=None, max_output=None, max_ratio=None):
+        """
+        channels is an iterable of the channel ids to subscribe to,
+        or None to subscribe to all of them. max_output and max_ratio
+        limit each channel, as for L{ByteDecoder}.
+        """
+        self.max_output = max_output
+        self.max_ratio = max_ratio
+
+        self._all = channels is None
+        self._subscribed = set(channels or [])
+        self._unsubscribed = set()
+        self._decoders = {}
+        self._buffer = bytearray()
+
+
+    def subscribe(self, channel):
+        """
+        Starts decoding channel, from the start of its next page.
+        """
+        self._subscribed.add(channel)
+        self._unsubscribed.discard(channel)
+
+
+    def unsubscribe(self, channel):
+        """
+        Stops decoding channel, and drops its decoder.
+        """
+        self._subscribed.discard(channel)
+        self._unsubscribed.add(channel)
+        self._decoders.pop(channel, None)
+
+
+    def feed(self, data):
+        """
+        Given the next bytes-like chunk of the stream, returns a list
+        of (channel, bytes) pairs of what it decodes to, in order.
+        Partial frames are kept for the next call.
+        """
+        buff = self._buffer
+        buff.extend(data)
+
+        decoded = []
+        start = 0
+        while len(buff) - start >= _FRAME_HEADER_SIZE:
+            (marker, flags, channel, length) = struct.unpack_from(_FRAME_HEADER, buff, start)
+            if marker != CHANNEL_MARKER:
+                raise ValueError("Bad frame marker {0:#04x}".format(marker))
+
+            end = start + _FRAME_HEADER_SIZE + length
+            if end > len(buff):
+                break
+
+            if channel in self._subscribed or (self._all and channel not in self._unsubscribed):
+                decoder = self._decoders.get(channel)
+                if decoder is None and flags & _FRAME_PAGESTART:
+                    decoder = ByteDecoder(max_output=self.max_output, max_ratio=self.max_ratio)
+                    decoder._keeppages = False
+                    self._decoders[ channel ] = decoder
+
+                if decoder is not None and length:
+                    output = decoder.decodechunk(buff[start + _FRAME_HEADER_SIZE:end])
+                    if output:
+                        decoded.append((channel, output))
+
+                if flags & _FRAME_END:
+                    self._decoders.pop(channel, None)
+
+            start = end
+
+        del buff[:start]
+        return decoded
+
+
+    def decodefrombytes(self, bytesource):
+        """
+        Given an iterable over the bytes of the stream, yields
+        (channel, bytes) pairs of what it decodes to.
+        """
+        for piece in _bytepieces(bytesource):
+            for pair in self.feed(piece):
+                yield pair
+
+
+
+class HorizontalPredictor(object):
+    """
+    TIFF's horizontal differencing predictor (Predictor=2, see page 64
+    of the TIFF 6.0 spec.) Smooth images don't compress well with LZW
+    on their own, but the differences between neighboring samples do,
+    so we replace each byte in a row with its difference (mod 256)
+    from the byte pixel_size bytes to its left, and undo that after
+    decompression.
+
+    row_width is the number of pixels per row, and pixel_size the
+    number of bytes per pixel (3 for 8-bit RGB, as in a PPM.) Only
+    8-bit samples are supported: wider ones would have to be
+    differenced as whole values, so any other bits_per_sample raises
+    a ValueError. Rows are independent, so any run of whole rows can
+    be predicted on its own, and the stages compose with L{compress}
+    and L{decompress}
+
+    >>> import lzw
+    >>> predictor = lzw.HorizontalPredictor(4, pixel_size=1)
+    >>> ramp = b"\\x00\\x01\\x02\\x03\\x10\\x11\\x12\\x13"
+    >>> predictor.encodechunk(ramp) == b"\\x00\\x01\\x01\\x01\\x10\\x01\\x01\\x01"
+    True
+    >>> compressed = b"".join(lzw.compress(predictor.encode(ramp)))
+    >>> b"".join(predictor.decode(lzw.decompress(compressed))) == ramp
+    True
+
+    or, with pages of whole rows, with L{PagingEncoder}
+
+    >>> pager = lzw.PagingEncoder(258, 2**12)
+    >>> pages = [ predictor.encodechunk(page) for page in [ ramp, ramp ] ]
+    >>> compressed = b"".join(pager.encodepages(pages))
+
+    NumPy is used for whole rows if it is installed.
+    """
+
+    def __init__(self, row_width, pixel_size=1, bits_per_sample=8):
+        if row_width < 1 or pixel_size < 1:
+            raise ValueError("row_width and pixel_size must be positive")
+        if bits_per_sample != 8:
+            raise ValueError("Only 8-bit samples can be predicted, not {0}-bit".format(bits_per_sample))
+
+        self.row_width = row_width
+        self.pixel_size = pixel_size
+        self.row_size = row_width * pixel_size
+
+
+    def encode(self, bytesource):
+        """
+        Given an iterable over bytes, returns an iterator over byte
+        strings of predicted rows, suitable for passing to
+        L{compress}. A short last row is predicted like the others.
+        """
+        return self._rows(bytesource, self.encodechunk)
+
+
+    def decode(self, bytesource):
+        """
+        Given an iterable over predicted bytes (say, the output of
+        L{decompress}), returns an iterator over byte strings of
+        restored rows.
+        """
+        return self._rows(bytesource, self.decodechunk)
+
+
+    def encodechunk(self, data):
+        """
+        Returns the prediction of data, which should start at the
+        beginning of a row, as a byte string.
+        """
+        whole = self._wholerows(data)
+
+        if numpy is not None and whole:
+            rows = numpy.frombuffer(data, dtype=numpy.uint8, count=whole).reshape(-1, self.row_size)
+            predicted = rows.copy()
+            predicted[:, self.pixel_size:] -= rows[:, :-self.pixel_size]
+            return predicted.tobytes() + self._encoderow(data[whole:])
+
+        return b"".join(self._encoderow(data[start:start + self.row_size])
+                        for start in range(0, len(data), self.row_size))
+
+
+    def decodechunk(self, data):
+        """
+        Undoes L{encodechunk}, returning the restored rows of data as a
+        byte string.
+        """
+        whole = self._wholerows(data)
+
+        if numpy is not None and whole:
+            rows = numpy.frombuffer(data, dtype=numpy.uint8, count=whole)
+            rows = rows.reshape(-1, self.row_width, self.pixel_size)
+            restored = numpy.cumsum(rows, axis=1, dtype=numpy.uint8)
+            return restored.tobytes() + self._decoderow(data[whole:])
+
+        return b"".join(self._decoderow(data[start:start + self.row_size])
+                        for start in range(0, len(data), self.row_size))
+
+
+    def _wholerows(self, data):
+        return len(data) - (len(data) % self.row_size)
+
+
+    def _encoderow(self, row):
+        row = bytearray(row)
+        stride = self.pixel_size
+        predicted = row[:stride]
+        predicted.extend((b - a) & 0xFF for (a, b) in zip(row, row[stride:]))
+        return bytes(predicted)
+
+
+    def _decoderow(self, row):
+        row = bytearray(row)
+        stride = self.pixel_size
+        for i in range(stride, len(row)):
+            row[i] = (row[i] + row[i - stride]) & 0xFF
+        return bytes(row)
+
+
+    def _rows(self, bytesource, stage):
+        # Batches of whole rows go through stage; a partial row is held
+        # back until we've seen the rest of it (or the end.)
+        chunksize = max(self.row_size, DEFAULT_CHUNK_SIZE - DEFAULT_CHUNK_SIZE % self.row_size)
+        pending = bytearray()
+        for chunk in _bytechunks(bytesource, chunksize):
+            pending.extend(chunk)
+            whole = len(pending) - (len(pending) % self.row_size)
+            if whole:
+                yield stage(bytes(pending[:whole]))
+                del pending[:whole]
+
+        if pending:
+            yield stage(bytes(pending))
+
+
+
+# Checkpoints of L{ByteEncoder} and L{ByteDecoder} state are a header
+# (magic, version, kind, flags, early change, max width (0 for
+# decoders), preset id and byte counts), the bit packer or unpacker's state, and then the codebook,
+# as the prefix code and last byte of each entry past the initial
+# ones. Decoders add any partial page header and their page start.
+
+def _checkpointheader(kind, flag, early_change, preset, bytes_in, bytes_out, ended=False, max_width=0):
+    flags = 0
+    if flag:
+        flags = flags | _CHECKPOINT_FLAG
+    if ended:
+        flags = flags | _CHECKPOINT_ENDED
+
+    dictionary_id = 0
+    if preset is not None:
+        flags = flags | _CHECKPOINT_PRESET
+        dictionary_id = preset.dictionary_id
+
+    if early_change is None:
+        early_change = -1
+
+    return struct.pack(_CHECKPOINT_HEADER, _CHECKPOINT_MAGIC, _CHECKPOINT_VERSION, kind, flags,
+                       early_change, max_width, dictionary_id, bytes_in, bytes_out)
+
+
+def _readcheckpoint(data, kind, early_change, ended=False, max_width=0):
+    # Returns the flag, preset id (or None), byte counts and the
+    # offset of what follows the header, and the ended flag if asked.
+    if len(data) < struct.calcsize(_CHECKPOINT_HEADER):
+        raise ValueError("Checkpoint is truncated")
+
+    (magic, version, datakind, flags, data_early_change, data_max_width, dictionary_id,
+     bytes_in, bytes_out) = struct.unpack_from(_CHECKPOINT_HEADER, data)
+
+    if magic != _CHECKPOINT_MAGIC:
+        raise ValueError("Not an lzw checkpoint")
+    if version != _CHECKPOINT_VERSION:
+        raise ValueError("Unsupported checkpoint version {0}".format(version))
+    if datakind != kind:
+        raise ValueError("Checkpoint is for the other direction")
+    if data_early_change != (-1 if early_change is None else early_change):
+        raise ValueError("Checkpoint was taken with a different early_change")
+    if data_max_width != max_width:
+        raise ValueError("Checkpoint was taken with a different max_width")
+
+    if not flags & _CHECKPOINT_PRESET:
+        dictionary_id = None
+
+    result = (bool(flags & _CHECKPOINT_FLAG), dictionary_id, bytes_in, bytes_out,
+              struct.calcsize(_CHECKPOINT_HEADER))
+    if ended:
+        result = result + (bool(flags & _CHECKPOINT_ENDED),)
+
+    return result
+
+
+def _dumpbits(packer):
+    # Works for a BitPacker or a BitUnpacker
+    return struct.pack(_CHECKPOINT_BITS, packer._codesize, packer._width, packer._nbits, packer._bits)
+
+
+def _loadbits(packer, data, offset):
+    (packer._codesize, packer._width, packer._nbits, packer._bits) = struct.unpack_from(
+        _CHECKPOINT_BITS, data, offset)
+    return offset + struct.calcsize(_CHECKPOINT_BITS)
+
+
+def _dumpcodebook(codes, initial, entries, pending):
+    # codes maps strings back to codes, entries holds the strings
+    # for the codes from initial on, pending is a code or None.
+    fmt = "H"
+    if initial + len(entries) > 0x10000:
+        fmt = "I"
+
+    prefixcodes = [ codes[ entry[:-1] ] for entry in entries ]
+    head = struct.pack(_CHECKPOINT_CODEBOOK, initial, len(entries),
+                       _NO_CODE if pending is None else pending, struct.calcsize(fmt))
+
+    return (head + struct.pack(">{0}{1}".format(len(entries), fmt), *prefixcodes) +
+            b"".join(entry[-1:] for entry in entries))
+
+
+def _loadcodebook(data, offset, initialstrings):
+    # Returns the entries and the pending string (or None) dumped by
+    # _dumpcodebook, and the offset just past them.
+    (initial, count, pending, codewidth) = struct.unpack_from(_CHECKPOINT_CODEBOOK, data, offset)
+    if initial != len(initialstrings):
+        raise ValueError("Checkpoint was taken with a different codebook")
+
+    offset = offset + struct.calcsize(_CHECKPOINT_CODEBOOK)
+    fmt = ">{0}{1}".format(count, "H" if codewidth == 2 else "I")
+    prefixcodes = struct.unpack_from(fmt, data, offset)
+    offset = offset + struct.calcsize(fmt)
+    lastbytes = data[offset:offset + count]
+    offset = offset + count
+
+    if len(lastbytes) != count:
+        raise ValueError("Checkpoint is truncated")
+
+    entries = []
+    for (index, prefixcode) in enumerate(prefixcodes):
+        if prefixcode < initial and isinstance(initialstrings[ prefixcode ], six.binary_type):
+            prefix = initialstrings[ prefixcode ]
+        elif initial <= prefixcode < initial + index:
+            prefix = entries[ prefixcode - initial ]
+        else:
+            raise ValueError("Checkpoint codebook is corrupt")
+
+        entries.append(prefix + lastbytes[index:index + 1])
+
+    if pending == _NO_CODE:
+        pending = None
+    elif pending < initial:
+        pending = initialstrings[ pending ]
+    elif pending < initial + count:
+        pending = entries[ pending - initial ]
+    else:
+        raise ValueError("Checkpoint codebook is corrupt")
+
+    return (entries, pending, offset)
+
+
+
+class PresetDictionary(object):
+    """
+    A frozen set of code strings that primes the codebooks of an
+    L{Encoder} and a L{Decoder}, so that short inputs that look like
+    the strings in the dictionary compress well from their very first
+    byte. Entries get the codes following END_OF_INFO_CODE, in order,
+    and every prefix of an entry is added ahead of it when it isn't
+    already there (the encoder can only ever reach a string through
+    its prefixes).
+
+    A stream compressed with a preset begins with PRESET_MARKER and
+    the dictionary's 32 bit id, so decoders know which dictionary to
+    prime with.
+
+    >>> import lzw
+    >>> preset = lzw.PresetDictionary([ b'{"name": "', b'", "id": ' ])
+    >>> preset.code_size()
+    275
+    >>> record = b'{"name": "gabba", "id": 12}'
+    >>> compressed = b"".join(lzw.compress(record, preset=preset))
+    >>> len(compressed) < len(b"".join(lzw.compress(record)))
+    True
+    >>> b"".join(lzw.decompress(compressed, preset=preset)) == record
+    True
+    """
+
+    def __init__(self, entries, dictionary_id=None):
+        """
+        entries is an iterable of byte strings. Single bytes are
+        always in the codebook, and are skipped, as are repeats. If
+        dictionary_id isn't given, it's derived from the entries.
+        """
+        self.entries = []
+        self._prefixes = dict(_INITIAL_PREFIXES)
+
+        for entry in entries:
+            for end in range(2, len(entry) + 1):
+                if entry[:end] not in self._prefixes:
+                    self._prefixes[ entry[:end] ] = len(self._prefixes)
+                    self.entries.append(entry[:end])
+
+        self._codepoints = dict(_INITIAL_CODEPOINTS)
+        for (code, entry) in enumerate(self.entries, len(_INITIAL_CODEPOINTS)):
+            self._codepoints[ code ] = entry
+
+        if dictionary_id is None:
+            dictionary_id = zlib.crc32(b"\0".join(self.entries)) & 0xFFFFFFFF
+
+        self.dictionary_id = dictionary_id
+
+
+    def code_size(self):
+        """
+        Returns the size of a codebook primed with this dictionary,
+        including the single bytes and control codes.
+        """
+        return len(self._prefixes)
+
+
+    def header(self):
+        """
+        Returns the bytes that identify this dictionary at the head of
+        a compressed stream.
+        """
+        return struct.pack(">BI", PRESET_MARKER, self.dictionary_id)
+
+
+    def tobytes(self):
+        """
+        Serializes the dictionary for L{dictionaryfrombytes}: a magic
+        number, a format version, the dictionary id and entry count,
+        a table of the entries' end offsets and then the entries
+        themselves, back to back.
+
+        >>> import lzw
+        >>> preset = lzw.PresetDictionary([ b"gabba" ], dictionary_id=7)
+        >>> data = preset.tobytes()
+        >>> data[:4] == b"LZWD"
+        True
+        >>> copy = lzw.dictionaryfrombytes(data)
+        >>> copy.dictionary_id, copy.entries == preset.entries
+        (7, True)
+        """
+        ends = []
+        end = 0
+        for entry in self.entries:
+            end = end + len(entry)
+            ends.append(end)
+
+        head = struct.pack(_DICTIONARY_HEADER, _DICTIONARY_MAGIC, _DICTIONARY_VERSION,
+                           self.dictionary_id, len(self.entries))
+        offsets = struct.pack(">{0}I".format(len(ends)), *ends)
+
+        return head + offsets + b"".join(self.entries)
+
+
+_LOOKAHEAD_MARGIN = 1024
+
+_PAGE_HEADER = ">BIII"
+_PAGE_HEADER_SIZE = struct.calcsize(_PAGE_HEADER)
+
+_FRAME_HEADER = ">BBII"
+_FRAME_HEADER_SIZE = struct.calcsize(_FRAME_HEADER)
+_FRAME_PAGESTART = 0x01
+_FRAME_END = 0x02
+
+_DICTIONARY_MAGIC = b"LZWD"
+_DICTIONARY_VERSION = 1
+_DICTIONARY_HEADER = ">4sBII"
 
-        Trailing bits at the end of the given iterator, after the last
-        codepoint, will be dropped on the floor.
+_CHECKPOINT_MAGIC = b"LZWC"
+_CHECKPOINT_VERSION = 2
+_CHECKPOINT_HEADER = ">4sBcBbBIQQ"
+_CHECKPOINT_BITS = ">IBBQ"
+_CHECKPOINT_CODEBOOK = ">IIIB"
+_CHECKPOINT_FLAG = 0x01
+_CHECKPOINT_PRESET = 0x02
+_CHECKPOINT_ENDED = 0x04
+_NO_CODE = 0xFFFFFFFF
 
-        At the end of the iteration, or when an END_OF_INFO_CODE seen
-        the unpacker will ignore the bits after the code until it
-        reaches the next aligned byte. END_OF_INFO_CODE will *not*
-        stop the generator, just reset the alignment and the width
 
+_BYTES = [ struct.pack("B", b) for b in range(256) ]
 
-        >>> import lzw, six
-        >>> unpk = lzw.BitUnpacker(initial_code_size=258)
-        >>> [ i for i in unpk.unpack([ six.int2byte(0), six.int2byte(0xC0), six.int2byte(0x40) ]) ]
-        [1, 257]
-        """
-        bits = []
-        offset = 0
-        ignore = 0
-        
-        codesize = self._initial_code_size
-        minwidth = 8
-        while (1 << minwidth) < codesize:
-            minwidth = minwidth + 1
+_INITIAL_PREFIXES = dict( (struct.pack("B", codept), codept) for codept in range(256) )
+_INITIAL_CODEPOINTS = dict( (codept, struct.pack("B", codept)) for codept in range(256) )
 
-        pointwidth = minwidth
+# Teensy hack, CLEAR_CODE and END_OF_INFO_CODE aren't equal to any
+# possible string.
+for _control in (CLEAR_CODE, END_OF_INFO_CODE):
+    _INITIAL_PREFIXES[ _control ] = _control
+    _INITIAL_CODEPOINTS[ _control ] = _control
 
-        for nextbit in bytestobits(bytesource):
 
-            offset = (offset + 1) % 8
-            if ignore > 0:
-                ignore = ignore - 1
-                continue
 
-            bits.append(nextbit)
+def train_dictionary(samples, max_entries=DEFAULT_PRESET_ENTRIES, max_width=DEFAULT_MAX_BITS):
+    """
+    Builds a L{PresetDictionary} from an iterable of sample byte
+    strings, meant to look like the (small) inputs you'll compress
+    with it. Each sample is run through an L{Encoder}, and the code
+    strings it emits are ranked by how often they're used, most used
+    (and then longest) first. The best of them, along with the
+    prefixes they depend on, make up the dictionary's at most
+    max_entries entries.
+
+    The samples are encoded back to back by a single L{Encoder}, so
+    that strings shared between samples build up in its codebook the
+    way they would in one big stream.
+
+    >>> import lzw
+    >>> samples = [ b'{"name": "gabba", "id": 12}', b'{"name": "yo", "id": 3}' ] * 8
+    >>> preset = lzw.train_dictionary(samples, max_entries=64)
+    >>> len(preset.entries) <= 64
+    True
+    >>> b'{"name"' in preset.entries
+    True
+    """
+    if len(_INITIAL_PREFIXES) + max_entries >= 2 ** max_width:
+        raise ValueError("Too many entries for a {0} bit codebook".format(max_width))
 
-            if len(bits) == pointwidth:
-                codepoint = intfrombits(bits)
-                bits = []
+    counts = collections.Counter()
+    encoder = Encoder(max_code_size=2**max_width)
+    decoder = Decoder()
 
-                yield codepoint
+    for codepoint in encoder.encode(itertools.chain.from_iterable(samples)):
+        decoded = decoder._decode_codepoint(codepoint)
+        if len(decoded) > 1:
+            counts[ decoded ] = counts[ decoded ] + 1
 
-                codesize = codesize + 1
+    ranked = sorted(counts, key=lambda entry: (-counts[ entry ], -len(entry), entry))
 
-                if codepoint in [ CLEAR_CODE, END_OF_INFO_CODE ]:
-                    codesize = self._initial_code_size
-                    pointwidth = minwidth
-                else:
-                    # is this too late?
-                    while codesize >= (2 ** pointwidth):
-                        pointwidth = pointwidth + 1
+    chosen = []
+    known = set()
+    for entry in ranked:
+        missing = [ entry[:end] for end in range(2, len(entry) + 1) if entry[:end] not in known ]
+        if len(chosen) + len(missing) > max_entries:
+            continue
 
-                if codepoint == END_OF_INFO_CODE:
-                    ignore = (8 - offset) % 8
+        chosen.extend(missing)
+        known.update(missing)
 
+    return PresetDictionary(chosen)
 
 
-class Decoder(object):
+def dictionaryfrombytes(data):
     """
-    Uncompresses a stream of lzw code points, as created by
-    L{Encoder}. Given a list of integer code points, with all
-    unpacking foolishness complete, turns that list of codepoints into
-    a list of uncompressed bytes. See L{BitUnpacker} for what this
-    doesn't do.
+    Given a bytes-like object (a byte string, an mmap...) holding the
+    output of L{PresetDictionary.tobytes}, returns the dictionary.
     """
-    def __init__(self):
-       """
-       Creates a new Decoder. Decoders should not be reused for
-       different streams.
-       """
-       self._clear_codes()
-       self.remainder = []
+    if len(data) < struct.calcsize(_DICTIONARY_HEADER):
+        raise ValueError("Not an lzw preset dictionary")
 
+    (magic, version, dictionary_id, count) = struct.unpack_from(_DICTIONARY_HEADER, data, 0)
+    if magic != _DICTIONARY_MAGIC or version != _DICTIONARY_VERSION:
+        raise ValueError("Not an lzw preset dictionary")
 
-    def code_size(self):
-       """
-       Returns the current size of the Decoder's code book, that is,
-       it's mapping of codepoints to byte strings. The return value of
-       this method will change as the decode encounters more encoded
-       input, or control codes.
-       """
-       return len(self._codepoints)
+    offset = struct.calcsize(_DICTIONARY_HEADER)
+    ends = struct.unpack_from(">{0}I".format(count), data, offset)
+    offset = offset + 4 * count
 
+    entries = []
+    start = 0
+    for end in ends:
+        entries.append(data[offset + start:offset + end])
+        start = end
 
-    def decode(self, codepoints):
-        """
-        Given an iterable of integer codepoints, yields the
-        corresponding bytes, one at a time, as byte strings of length
-        E{1}. Retains the state of the codebook from call to call, so
-        if you have another stream, you'll likely need another
-        decoder!
+    return PresetDictionary(entries, dictionary_id=dictionary_id)
 
-        Decoders will NOT handle END_OF_INFO_CODE (rather, they will
-        handle the code by throwing an exception); END_OF_INFO should
-        be handled by the upstream codepoint generator (see
-        L{BitUnpacker}, for example)
 
-        >>> import lzw
-        >>> dec = lzw.Decoder()
-        >>> result = b''.join(dec.decode([103, 97, 98, 98, 97, 32, 258, 260, 262, 121, 111, 263, 259, 261, 256]))
-        >>> result == b'gabba gabba yo gabba'
-        True
+def readdictionary(filename):
+    """
+    Loads a L{PresetDictionary} written by L{writedictionary}, mapping
+    the file rather than reading it.
+    """
+    with io.open(filename, "rb") as infile:
+        # Empty files can't be mapped, and short ones are no dictionary
+        if os.fstat(infile.fileno()).st_size < struct.calcsize(_DICTIONARY_HEADER):
+            raise ValueError("Not an lzw preset dictionary")
 
-        """
-        codepoints = [ cp for cp in codepoints ]
+        mapped = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return dictionaryfrombytes(mapped)
+        finally:
+            mapped.close()
 
-        for cp in codepoints:
-            decoded = self._decode_codepoint(cp)
-            for character in six.iterbytes(decoded):
-                # TODO optimize, casting back to bytes when bytes above
-                yield six.int2byte(character)
 
+def writedictionary(filename, preset):
+    """
+    Saves a L{PresetDictionary} to a file, for L{readdictionary}.
+    """
+    with io.open(filename, "wb") as outfile:
+        outfile.write(preset.tobytes())
 
 
-    def _decode_codepoint(self, codepoint):
-        """
-        Will raise a ValueError if given an END_OF_INFORMATION
-        code. EOI codes should be handled by callers if they're
-        present in our source stream.
 
-        >>> import lzw
-        >>> dec = lzw.Decoder()
-        >>> beforesize = dec.code_size()
-        >>> dec._decode_codepoint(0x80) == b'\\x80'
-        True
-        >>> dec._decode_codepoint(0x81) == b'\\x81'
-        True
-        >>> beforesize + 1 == dec.code_size()
-        True
-        >>> dec._decode_codepoint(256) == b''
-        True
-        >>> beforesize == dec.code_size()
-        True
-        """
+class LRUCache(object):
+    """
+    A thread safe, least-recently-used cache of byte strings, bounded
+    by the total length of the values it holds rather than by their
+    count. Counts its hits, misses and evictions.
 
-        ret = b""
+    >>> import lzw
+    >>> cache = lzw.LRUCache(max_bytes=10)
+    >>> cache.put("a", b"gabba")
+    >>> cache.put("b", b"yo")
+    >>> cache.get("a") == b"gabba"
+    True
+    >>> cache.put("c", b"hammer")
+    >>> cache.get("b") is None
+    True
+    >>> cache.size, cache.hits, cache.misses, cache.evictions
+    (6, 1, 1, 2)
+    """
 
-        if codepoint == CLEAR_CODE:
-            self._clear_codes()
-        elif codepoint == END_OF_INFO_CODE:
-            raise ValueError("End of information code not supported directly by this Decoder")
-        else:
-            if codepoint in self._codepoints:
-                ret = self._codepoints[ codepoint ]
-                if None != self._prefix:
-                    self._codepoints[ len(self._codepoints) ] = self._prefix + six.int2byte(six.indexbytes(ret, 0))
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
-            else:
-                ret = self._prefix + six.int2byte(six.indexbytes(self._prefix, 0))
-                self._codepoints[ len(self._codepoints) ] = ret
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
 
-            self._prefix = ret
 
-        return ret
+    def __len__(self):
+        return len(self._entries)
 
 
-    def _clear_codes(self):
-        self._codepoints = dict( (pt, struct.pack("B", pt)) for pt in range(256) )
-        self._codepoints[CLEAR_CODE] = CLEAR_CODE
-        self._codepoints[END_OF_INFO_CODE] = END_OF_INFO_CODE
-        self._prefix = None
+    def get(self, key):
+        """
+        Returns the value cached for key, or None, marking it as the
+        most recently used.
+        """
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is None:
+                self.misses = self.misses + 1
+                return None
 
+            self._entries[ key ] = value
+            self.hits = self.hits + 1
+            return value
 
-class Encoder(object):
-    """
-    Given an iterator of bytes, returns an iterator of integer
-    codepoints, suitable for use by L{Decoder}. The core of the
-    "compression" side of lzw compression/decompression.
-    """
-    def __init__(self, max_code_size=(2**DEFAULT_MAX_BITS)):
+
+    def put(self, key, value):
         """
-        When the encoding codebook grows larger than max_code_size,
-        the Encoder will clear its codebook and emit a CLEAR_CODE
+        Caches value under key, evicting the least recently used
+        values until everything fits in max_bytes. Values bigger than
+        max_bytes on their own aren't cached at all.
         """
+        if len(value) > self.max_bytes:
+            return
 
-        self.closed = False
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size = self.size - len(old)
 
-        self._max_code_size = max_code_size
-        self._buffer = b''
-        self._clear_codes()            
+            self._entries[ key ] = value
+            self.size = self.size + len(value)
 
-        if max_code_size < self.code_size():
-            raise ValueError("Max code size too small, (must be at least {0})".format(self.code_size()))
+            while self.size > self.max_bytes:
+                (_, evicted) = self._entries.popitem(last=False)
+                self.size = self.size - len(evicted)
+                self.evictions = self.evictions + 1
 
 
-    def code_size(self):
+    def clear(self):
         """
-        Returns a count of the known codes, including codes that are
-        implicit in the data but have not yet been produced by the
-        iterator.
+        Empties the cache. Leaves the counters alone.
         """
-        return len(self._prefixes)
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
 
 
-    def flush(self):
+
+class CodecCache(object):
+    """
+    Remembers the results of compressing and decompressing payloads,
+    keyed by a hash of their content, so that repeat work on hot
+    payloads is a lookup. Results are held in an L{LRUCache} of
+    max_bytes, and, if a directory is given, in files there too, so
+    they survive eviction and restarts.
+
+    >>> import lzw
+    >>> cache = lzw.CodecCache(max_bytes=2**20)
+    >>> compressed = cache.compress(b"gabba gabba yo gabba")
+    >>> compressed == b"".join(lzw.compress(b"gabba gabba yo gabba"))
+    True
+    >>> compressed is cache.compress(b"gabba gabba yo gabba")
+    True
+    >>> cache.decompress(compressed) == b"gabba gabba yo gabba"
+    True
+    >>> cache.memory.hits, cache.memory.misses
+    (1, 2)
+    """
+
+    def __init__(self, max_bytes, directory=None, max_width=DEFAULT_MAX_BITS, preset=None):
         """
-        Yields any buffered codepoints, followed by a CLEAR_CODE, and
-        clears the codebook as a side effect.
+        max_width and preset are as for L{compress}, and are applied
+        to every payload going through the cache. Since payloads are
+        compressed with it, preset must be a single
+        L{PresetDictionary}, not a sequence of them; a ValueError is
+        raised otherwise.
         """
+        if preset is not None and not isinstance(preset, PresetDictionary):
+            raise ValueError("CodecCache takes a single PresetDictionary as its preset")
 
-        flushed = []
-
-        if self._buffer:
-            yield self._prefixes[ self._buffer ]
-            self._buffer = b''
+        self.memory = LRUCache(max_bytes)
+        self.directory = directory
+        self.disk_hits = 0
 
-        yield CLEAR_CODE
-        self._clear_codes()
+        self._max_width = max_width
+        self._preset = preset
+        self._lock = threading.Lock()
 
-            
+        # Results depend on the settings as well as the payload, so
+        # they're part of every key (caches may share a directory)
+        self._settings = str(max_width)
+        if preset is not None:
+            self._settings = "{0}-{1:08x}".format(max_width, preset.dictionary_id)
 
 
-    def encode(self, bytesource):
+    def compress(self, data):
         """
-        Given an iterator over bytes, yields the
-        corresponding stream of codepoints.
-        Will clear the codes at the end of the stream.
+        Returns the compressed bytes for the byte string data.
+        """
+        return self._lookup("c", data, self._compress)
 
-        >>> import lzw
-        >>> enc = lzw.Encoder()
-        >>> [ cp for cp in enc.encode(b"gabba gabba yo gabba") ]
-        [103, 97, 98, 98, 97, 32, 258, 260, 262, 121, 111, 263, 259, 261, 256]
 
+    def decompress(self, data):
         """
-        for b in bytesource:
-            for point in self._encode_byte(b):
-                yield point
+        Returns the uncompressed bytes for the compressed byte string
+        data.
+        """
+        return self._lookup("d", data, self._decompress)
 
-            if self.code_size() >= self._max_code_size:
-                for pt in self.flush():
-                    yield pt
-        
-        for point in self.flush():
-            yield point
 
+    def _compress(self, data):
+        encoder = ByteEncoder(max_width=self._max_width, preset=self._preset)
+        return encoder.encodechunk(data) + encoder.flush()
 
-    def _encode_byte(self, point):
-        # Yields one or zero bytes, AND changes the internal state of
-        # the codebook and prefix buffer.
-        #
-        # Unless you're in self.encode(), you almost certainly don't
-        # want to call this.
 
-        # In python3 iterating over the bytestring will return in codepoints,
-        # we use the byte([]) constructor to conver this back into bytestring
-        # so we can add to new_prefix and key the _prefixes by the bytestring.
-        byte = point if isinstance(point, six.binary_type) else six.int2byte(point)
+    def _decompress(self, data):
+        decoder = ByteDecoder(preset=self._preset)
+        return decoder.decodechunk(data)
 
-        new_prefix = self._buffer
 
-        if new_prefix + byte in self._prefixes:
-            new_prefix = new_prefix + byte
-        elif new_prefix:
-            encoded = self._prefixes[ new_prefix ]
-            self._add_code(new_prefix + byte)
-            new_prefix = byte
+    def _lookup(self, operation, data, compute):
+        key = "{0}{1}-{2}".format(operation, self._settings, hashlib.sha1(data).hexdigest())
 
-            yield encoded
-        
-        self._buffer = new_prefix
+        value = self.memory.get(key)
+        if value is not None:
+            return value
 
+        value = self._readfile(key)
+        if value is None:
+            value = compute(data)
+            self._writefile(key, value)
 
+        self.memory.put(key, value)
+        return value
 
 
-    def _clear_codes(self):
+    def _readfile(self, key):
+        if self.directory is None:
+            return None
 
-        # Teensy hack, CLEAR_CODE and END_OF_INFO_CODE aren't
-        # equal to any possible string.
+        try:
+            with io.open(os.path.join(self.directory, key), "rb") as infile:
+                value = infile.read()
+        except (IOError, OSError):
+            return None
 
-        self._prefixes = dict( (struct.pack("B", codept), codept) for codept in range(256) )
-        self._prefixes[ CLEAR_CODE ] = CLEAR_CODE
-        self._prefixes[ END_OF_INFO_CODE ] = END_OF_INFO_CODE
+        with self._lock:
+            self.disk_hits = self.disk_hits + 1
+        return value
 
 
-    def _add_code(self, newstring):
-        self._prefixes[ newstring ] = len(self._prefixes)
+    def _writefile(self, key, value):
+        if self.directory is None:
+            return
 
+        # Write then rename, so readers never see half a file
+        (handle, temppath) = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(handle, "wb") as outfile:
+            outfile.write(value)
 
+        os.rename(temppath, os.path.join(self.directory, key))
 
-class PagingEncoder(object):
+
+
+class PageCache(object):
     """
-    UNTESTED. Handles encoding of multiple chunks or streams of encodable data,
-    separated with control codes. Dual of PagingDecoder.
+    Serves the decoded pages of paged files (see L{PagingEncoder})
+    from an L{LRUCache} of max_bytes, so hot pages of big archives
+    are decoded once rather than on every read. Pages are keyed by
+    the file's identity (its path, device, inode, size and
+    modification time, so a changed file is never served stale
+    pages) and their page number. Safe to share between threads.
+
+    Finding the pages of a file takes a pass over it, like
+    L{decompressed_page_sizes}, the first time the file is read; the
+    resulting index of page offsets is kept until L{clear}, or until
+    the file changes. Files compressed with a preset dictionary need
+    it (or a sequence of dictionaries including it) as preset.
+
+    >>> import lzw, tempfile, os
+    >>> enc = lzw.PagingEncoder(258, 2**12, checksums=True)
+    >>> (handle, filename) = tempfile.mkstemp()
+    >>> os.write(handle, b"".join(enc.encodepages([ b"say hammer", b"yo hammer" ])))
+    55
+    >>> os.close(handle)
+    >>> cache = lzw.PageCache(max_bytes=2**20)
+    >>> cache.page(filename, 1) == b"yo hammer"
+    True
+    >>> cache.read(filename, 4, 9) == b"hammeryo "
+    True
+    >>> cache.memory.hits, cache.memory.misses
+    (1, 2)
+    >>> os.remove(filename)
     """
-    def __init__(self, initial_code_size, max_code_size):
-        self._initial_code_size = initial_code_size
-        self._max_code_size = max_code_size
 
+    def __init__(self, max_bytes, preset=None):
+        if isinstance(preset, PresetDictionary):
+            preset = [ preset ]
 
-    def encodepages(self, pages):
-        """
-        Given an iterator of iterators of bytes, produces a single
-        iterator containing a delimited sequence of independantly
-        compressed LZW sequences, all beginning on a byte-aligned
-        spot, all beginning with a CLEAR code and all terminated with
-        an END_OF_INFORMATION code (and zero to seven trailing junk
-        bits.)
+        self.memory = LRUCache(max_bytes)
 
-        The dual of PagingDecoder.decodepages
+        self._presets = list(preset or [])
+        self._indexes = {}
+        self._lock = threading.Lock()
 
-        >>> import lzw
-        >>> enc = lzw.PagingEncoder(257, 2**12)
-        >>> coded = enc.encodepages([ b"say hammer yo hammer mc hammer go hammer", 
-        ...                           b"and the rest can go and play",
-        ...                           b"can't touch this" ])
-        ...
-        >>> result = b"".join(coded)
-        >>> result == b'\\x80\\x1c\\xcc\\'\\x91\\x01\\xa0\\xc2m6\\x99NB\\x03\\xc9\\xbe\\x0b\\x07\\x84\\xc2\\xcd\\xa68|"\\x14 3\\xc3\\xa0\\xd1c\\x94\\x02\\x02\\x80\\x18M\\xc6A\\x01\\xd0\\xd0e\\x10\\x1c\\x8c\\xa73\\xa0\\x80\\xc7\\x02\\x10\\x19\\xcd\\xe2\\x08\\x14\\x10\\xe0l0\\x9e`\\x10\\x10\\x80\\x18\\xcc&\\xe19\\xd0@t7\\x9dLf\\x889\\xa0\\xd2s\\x80@@'
-        True
 
+    def pagecount(self, filename):
+        """
+        Returns the number of pages in the file.
         """
+        return len(self._index(filename)[1]) - 1
 
-        for page in pages:
 
-            encoder = Encoder(max_code_size=self._max_code_size)
-            codepoints = encoder.encode(page)
-            codes_and_eoi = itertools.chain([ CLEAR_CODE ], codepoints, [ END_OF_INFO_CODE ])
+    def page(self, filename, number):
+        """
+        Returns the decoded bytes of page number of the file. Raises
+        an IndexError if there's no such page, and a L{ChecksumError}
+        if the page doesn't match its checksums.
+        """
+        while 1:
+            (identity, index, preset) = self._index(filename)
+            if not 0 <= number < len(index) - 1:
+                raise IndexError("Page {0} of {1} is out of range".format(number, filename))
+
+            key = (identity, number)
+            value = self.memory.get(key)
+            if value is not None:
+                return value
+
+            start = index[ number ][0]
+            end = index[ number + 1 ][0]
+            with io.open(identity[0], "rb") as infile:
+                # Only read pages from the file we indexed; if it's
+                # been replaced since, index the new one and go again
+                if _fileidentity(identity[0], os.fstat(infile.fileno())) == identity:
+                    infile.seek(start)
+                    data = infile.read(end - start)
+                    break
 
-            packer = BitPacker(initial_code_size=encoder.code_size())
-            packed = packer.pack(codes_and_eoi)
+        decoder = Decoder(preset=preset)
+        unpacker = BitUnpacker(initial_code_size=decoder.code_size())
+        (header, packed, ended) = _PageReader(data).nextpage(unpacker)
 
-            for byte in packed: 
-                yield byte
+        value = _decodepage(decoder, unpacker, header, packed, ended, number)
+        self.memory.put(key, value)
+        return value
 
 
-            
+    def read(self, filename, offset, size):
+        """
+        Returns up to size decoded bytes of the file, from the
+        decompressed offset on, pulling in the pages they span.
+        """
+        index = self._index(filename)[1]
+        number = max(bisect.bisect_right([ page[1] for page in index ], offset) - 1, 0)
 
-class PagingDecoder(object):
-    """
-    UNTESTED. Dual of PagingEncoder, knows how to handle independantly encoded,
-    END_OF_INFO_CODE delimited chunks of an inbound byte stream
-    """
+        pieces = []
+        end = offset + size
+        while offset < end and number < len(index) - 1:
+            pagestart = index[ number ][1]
+            page = self.page(filename, number)
+            pieces.append(page[offset - pagestart:end - pagestart])
+            offset = pagestart + len(page)
+            number = number + 1
 
-    def __init__(self, initial_code_size):
-        self._initial_code_size = initial_code_size
-        self._remains = []
+        return b"".join(pieces)
 
-    def next_page(self, codepoints):
+
+    def clear(self):
         """
-        Iterator over the next page of codepoints.
+        Forgets every cached page and page index. Leaves the counters
+        alone.
         """
-        self._remains = []
+        self.memory.clear()
+        with self._lock:
+            self._indexes.clear()
 
-        try:
-            while 1:
-                cp = six.next(codepoints)
-                if cp != END_OF_INFO_CODE:
-                    yield cp
-                else:
-                    self._remains = codepoints
-                    break
 
-        except StopIteration:
-            pass
-        
+    def _index(self, filename):
+        # Returns the file's identity, a list of (compressed,
+        # decompressed) offsets of the start of each page, and of the
+        # end of the last, and the file's preset dictionary (or None).
+        path = os.path.realpath(filename)
+        identity = _fileidentity(path, os.stat(path))
 
-    def decodepages(self, bytesource):
-        """
-        Takes an iterator of bytes, returns an iterator of iterators
-        of uncompressed data. Expects input to conform to the output
-        conventions of PagingEncoder(), in particular that "pages" are
-        separated with an END_OF_INFO_CODE and padding up to the next
-        byte boundary.
+        # One index per path, replaced when the file changes, so
+        # rewritten files don't pile up indexes
+        with self._lock:
+            indexed = self._indexes.get(path)
+        if indexed is not None and indexed[0] == identity:
+            return indexed
 
-        BUG: Dangling trailing page on decompression.
+        decoder = ByteDecoder(preset=self._presets)
+        with io.open(path, "rb") as infile:
+            identity = _fileidentity(path, os.fstat(infile.fileno()))
+            decoder.measure(iter(lambda: infile.read(DEFAULT_CHUNK_SIZE), b""))
 
-        >>> import lzw
-        >>> pgdec = lzw.PagingDecoder(initial_code_size=257)
-        >>> pgdecoded = pgdec.decodepages(
-        ...     b''.join([b'\\x80\\x1c\\xcc\\'\\x91\\x01\\xa0\\xc2m6',
-        ...               b'\\x99NB\\x03\\xc9\\xbe\\x0b\\x07\\x84\\xc2',
-        ...               b'\\xcd\\xa68|"\\x14 3\\xc3\\xa0\\xd1c\\x94',
-        ...               b'\\x02\\x02\\x80\\x18M\\xc6A\\x01\\xd0\\xd0e',
-        ...               b'\\x10\\x1c\\x8c\\xa73\\xa0\\x80\\xc7\\x02\\x10',
-        ...               b'\\x19\\xcd\\xe2\\x08\\x14\\x10\\xe0l0\\x9e`\\x10',
-        ...               b'\\x10\\x80\\x18\\xcc&\\xe19\\xd0@t7\\x9dLf\\x889',
-        ...               b'\\xa0\\xd2s\\x80@@'])
-        ... )
-        >>> result = [ b"".join(pg) for pg in pgdecoded ]
-        >>> result == [b'say hammer yo hammer mc hammer go hammer', b'and the rest can go and play', b"can't touch this", b'']
-        True
+        index = [ page for page in decoder.pages if page[0] < decoder.bytes_in ]
+        index.append((decoder.bytes_in, decoder.bytes_out))
 
-        """
+        # The first page follows the preset header, if there is one
+        preset = None
+        for (dictionary_id, codec) in decoder._codecs.items():
+            if dictionary_id is not None and codec[0] is decoder._decoder:
+                preset = decoder._presets[ dictionary_id ]
+                index[0] = (5, 0)
 
-        # TODO: WE NEED A CODE SIZE POLICY OBJECT THAT ISN'T THIS.
-        # honestly, we should have a "codebook" object we need to pass
-        # to bit packing/unpacking tools, etc, such that we don't have
-        # to roll all of these code size assumptions everyplace.
+        indexed = (identity, index, preset)
+        with self._lock:
+            self._indexes[ path ] = indexed
 
-        unpacker = BitUnpacker(initial_code_size=self._initial_code_size)
-        codepoints = unpacker.unpack(bytesource)
+        return indexed
 
-        self._remains = codepoints
-        while self._remains:
-            nextpoints = self.next_page(self._remains)
-            nextpoints = [ nx for nx in nextpoints ]
 
-            decoder = Decoder()
-            decoded = decoder.decode(nextpoints)
-            decoded = [ dec for dec in decoded ]
 
-            yield decoded
+def _fileidentity(path, stat):
+    # What PageCache takes a file to be: when any of it changes, it's
+    # another file, as far as cached pages go
+    return (path, stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime)
 
 
 
@@ -683,6 +3727,64 @@ class PagingDecoder(object):
 # Conveniences.
 
 
+def _byteview(buffer):
+    # Returns a flat memoryview of bytes over the writable buffer.
+    # Python 2.7 can't cast other formats to bytes, so they're a
+    # TypeError there; it also crashes on the format of the
+    # memoryviews its io hands out (and on wrapping them in another
+    # memoryview), so it goes by their item size instead.
+    view = buffer if isinstance(buffer, memoryview) else memoryview(buffer)
+    if not hasattr(view, "cast"):
+        if view.ndim != 1 or view.itemsize != 1:
+            raise TypeError("Only flat byte buffers can be written into on this Python")
+        return view
+
+    if view.ndim != 1 or view.format != "B":
+        view = view.cast("B")
+    return view
+
+
+def _bytechunks(bytesource, chunksize=DEFAULT_CHUNK_SIZE):
+    # Regroups bytesource, either a bytes-like object or an iterable
+    # over bytes (as integers or byte strings of any length), into
+    # bytearrays of about chunksize bytes.
+    if isinstance(bytesource, (six.binary_type, bytearray, memoryview)):
+        view = memoryview(bytesource)
+        for start in range(0, len(view), chunksize):
+            yield bytearray(view[start:start + chunksize])
+        return
+
+    chunk = bytearray()
+    for item in bytesource:
+        if isinstance(item, six.integer_types):
+            chunk.append(item)
+        else:
+            chunk.extend(item)
+
+        if len(chunk) >= chunksize:
+            yield chunk
+            chunk = bytearray()
+
+    if chunk:
+        yield chunk
+
+
+def _bytepieces(bytesource, chunksize=DEFAULT_CHUNK_SIZE):
+    # Like _bytechunks, but hands on the items of an iterable as
+    # bytearrays as soon as they arrive, without regrouping them, so
+    # that generators over streams don't read ahead of their output.
+    if isinstance(bytesource, (six.binary_type, bytearray, memoryview)):
+        for chunk in _bytechunks(bytesource, chunksize):
+            yield chunk
+        return
+
+    for item in bytesource:
+        if isinstance(item, six.integer_types):
+            yield bytearray((item,))
+        else:
+            yield bytearray(item)
+
+
 def unpackbyte(b):
    """
    Given a one-byte long byte string, returns an integer. Equivalent
@@ -710,7 +3812,7 @@ def readbytes(filename, buffersize=1024):
     Opens a file named by filename and iterates over the L{filebytes}
     found therein.  Will close the file when the bytes run out.
     """
-    with open(filename, "rb") as infile:
+    with io.open(filename, "rb") as infile:
         for byte in six.iterbytes(filebytes(infile, buffersize)):
             yield six.int2byte(byte)  # TODO optimize, we are re-casting to bytes
 
@@ -723,7 +3825,7 @@ def writebytes(filename, bytesource):
     from bytesource into it, and closes it
     """
 
-    with open(filename, "wb") as outfile:
+    with io.open(filename, "wb") as outfile:
         for bt in bytesource:
             outfile.write(bt)
 
@@ -0,0 +1,218 @@
+"""
+Command line tools for lzw. Run
+
+    python -m lzw --help
+
+for usage. Compressing and decompressing stream from standard input
+(or a file) to standard output (or a file) in constant memory, so they
+work in pipelines:
+
+    python -m lzw -c < big.tar | ssh elsewhere python -m lzw -d > big.tar
+
+"""
+
+import argparse
+import io
+import itertools
+import shutil
+import sys
+import time
+
+import six
+
+import lzw
+
+DEFAULT_BUFFER_SIZE = 2**20
+DEFAULT_PAGE_SIZE = 2**20
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="lzw",
+                                     description="Pure python LZW compression tools")
+
+    modes = parser.add_mutually_exclusive_group(required=True)
+    modes.add_argument("-c", "--compress", action="store_true",
+                       help="compress FILE (or standard input)")
+    modes.add_argument("-d", "--decompress", action="store_true",
+                       help="decompress FILE (or standard input)")
+    modes.add_argument("--train", metavar="DICTFILE",
+                       help="train a preset dictionary on the given sample files and write it to DICTFILE")
+
+    parser.add_argument("-o", "--output", metavar="OUTFILE",
+                        help="write to OUTFILE rather than standard output")
+    parser.add_argument("--max-width", type=int, default=lzw.DEFAULT_MAX_BITS,
+                        help="maximum code width in bits (default %(default)s)")
+    parser.add_argument("--buffer-size", type=int, default=DEFAULT_BUFFER_SIZE,
+                        help="size of reads and writes, in bytes (default %(default)s)")
+    parser.add_argument("--dictionary", metavar="DICTFILE",
+                        help="compress or decompress with a preset dictionary")
+    parser.add_argument("--paged", action="store_true",
+                        help="compress to independent pages, which can be compressed in parallel")
+    parser.add_argument("--page-size", type=_positive,
+                        help="uncompressed bytes per page (default {0})".format(DEFAULT_PAGE_SIZE))
+    parser.add_argument("--checksums", action="store_true",
+                        help="add checksums to each page (or, decompressing, check them)")
+    parser.add_argument("-j", "--jobs", type=int, metavar="WORKERS",
+                        help="compress pages with this many processes (default 1)")
+    parser.add_argument("--stats", action="store_true",
+                        help="report sizes, ratio and throughput on standard error")
+
+    parser.add_argument("--max-entries", type=int, default=lzw.DEFAULT_PRESET_ENTRIES,
+                        help="maximum number of entries in a trained dictionary (default %(default)s)")
+    parser.add_argument("--lines", action="store_true",
+                        help="treat each line of each sample file as a separate sample")
+    parser.add_argument("files", nargs="*", metavar="FILE")
+
+    args = parser.parse_args(argv)
+
+    # The library's errors (bad codes and checksums, limits, unknown
+    # dictionaries...) are all ValueErrors, and get a line, not a
+    # traceback
+    try:
+        return _run(parser, args)
+    except ValueError as e:
+        parser.exit(1, "{0}: error: {1}\n".format(parser.prog, e))
+
+
+def _run(parser, args):
+    if args.train:
+        if not args.files:
+            parser.error("--train needs at least one sample file")
+
+        preset = lzw.train_dictionary(_samples(args.files, args.lines),
+                                      max_entries=args.max_entries,
+                                      max_width=args.max_width)
+        lzw.writedictionary(args.train, preset)
+
+        sys.stderr.write("{0}: {1} entries, id {2:#010x}\n".format(
+                args.train, len(preset.entries), preset.dictionary_id))
+        return 0
+
+    if len(args.files) > 1:
+        parser.error("only one FILE can be compressed or decompressed at a time")
+    if args.paged and args.dictionary:
+        parser.error("--paged can't be used with --dictionary")
+    if not args.paged and (args.page_size is not None or args.checksums or args.jobs is not None):
+        parser.error("--page-size, --checksums and --jobs need --paged")
+    if args.decompress and (args.page_size is not None or args.jobs is not None):
+        parser.error("--page-size and --jobs are only for compressing")
+
+    preset = None
+    if args.dictionary:
+        preset = lzw.readdictionary(args.dictionary)
+
+    infile = _binary(sys.stdin)
+    if args.files and args.files[0] != "-":
+        infile = io.open(args.files[0], "rb")
+
+    outfile = _binary(sys.stdout)
+    if args.output:
+        outfile = io.open(args.output, "wb")
+
+    infile = _Counted(infile)
+    outfile = _Counted(outfile)
+    started = time.time()
+
+    try:
+        if args.decompress and args.checksums:
+            _decodechecked(infile, outfile, args.buffer_size)
+        elif args.decompress:
+            with lzw.open(infile, "rb", preset=preset, buffersize=args.buffer_size) as reader:
+                shutil.copyfileobj(reader, outfile, args.buffer_size)
+        elif args.paged:
+            encoder = lzw.PagingEncoder(lzw.END_OF_INFO_CODE + 1, 2**args.max_width, checksums=args.checksums)
+            page_size = args.page_size or DEFAULT_PAGE_SIZE
+            pages = iter(lambda: infile.read(page_size), b"")
+            for packed in encoder.encodedpages(pages, workers=args.jobs or 1):
+                outfile.write(packed)
+        else:
+            with lzw.open(outfile, "wb", max_width=args.max_width, preset=preset,
+                          buffersize=args.buffer_size) as writer:
+                shutil.copyfileobj(infile, writer, args.buffer_size)
+
+        outfile.flush()
+    finally:
+        infile.close()
+        outfile.close()
+
+    if args.stats:
+        _report(infile.count, outfile.count, time.time() - started, args.decompress)
+
+    return 0
+
+
+def _decodechecked(infile, outfile, buffersize):
+    # Decodes a checksummed paged stream a page at a time, checking
+    # each page against its checksums on the way.
+    first = infile.read(1)
+    if first and six.byte2int(first) != lzw.PAGE_MARKER:
+        raise ValueError("Input has no page checksums to check")
+
+    chunks = itertools.chain([ first ], iter(lambda: infile.read(buffersize), b""))
+    for page in lzw.PagingDecoder(lzw.END_OF_INFO_CODE + 1).decodepages(chunks):
+        outfile.write(b"".join(page))
+
+
+def _positive(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("{0} isn't a positive number".format(value))
+    return number
+
+
+class _Counted(object):
+    # Just enough of a binary file to count the bytes going through it
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self.count = 0
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        self.count = self.count + len(data)
+        return data
+
+    def write(self, data):
+        self._fileobj.write(data)
+        self.count = self.count + len(data)
+        return len(data)
+
+    def flush(self):
+        self._fileobj.flush()
+
+    def close(self):
+        if self._fileobj not in (_binary(sys.stdin), _binary(sys.stdout)):
+            self._fileobj.close()
+
+    def seekable(self):
+        return False
+
+
+def _binary(stream):
+    return getattr(stream, "buffer", stream)
+
+
+def _report(bytes_in, bytes_out, seconds, decompressing):
+    (uncompressed, compressed) = (bytes_in, bytes_out)
+    if decompressing:
+        (uncompressed, compressed) = (bytes_out, bytes_in)
+
+    ratio = float(uncompressed) / compressed if compressed else 0.0
+    rate = uncompressed / seconds / 2**20 if seconds else 0.0
+
+    sys.stderr.write("{0} bytes in, {1} bytes out, ratio {2:.3f}, {3:.2f}s, {4:.2f} MB/s\n".format(
+            bytes_in, bytes_out, ratio, seconds, rate))
+
+
+def _samples(filenames, lines):
+    for filename in filenames:
+        with open(filename, "rb") as infile:
+            if lines:
+                for line in infile:
+                    yield line
+            else:
+                yield infile.read()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
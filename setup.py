@@ -91,6 +91,10 @@ setup(name="lzw",
 
       install_requires=['six'],
 
+      entry_points = {
+        'console_scripts' : [ 'lzw = lzw.__main__:main' ],
+        },
+
       long_description = """
 A pure python module for compressing and decompressing streams of
 data, built around iterators. Requires python 2.6
@@ -0,0 +1,85 @@
+
+"""
+Throughput benchmarks. These aren't tests, and aren't run by the test
+command; run them from the top of the source tree with
+
+    python -m tests.bench
+
+"""
+
+import lzw
+
+import os
+import time
+
+TEST_ROOT = os.path.dirname(__file__)
+ENGLISH_FILE = os.path.join(TEST_ROOT, "data", "the_happy_prince.txt")
+PPM_FILE = os.path.join(TEST_ROOT, "data", "library-of-congress-smaller.ppm")
+PPM_BENCH_SIZE = 2**18
+
+BATCH_COUNT = 10000
+BATCH_PAYLOAD_SIZE = 1024
+
+
+def timed(function, *args, **kwargs):
+    start = time.time()
+    result = function(*args, **kwargs)
+    return result, time.time() - start
+
+
+def report(name, nbytes, seconds):
+    print("{0:<40} {1:8.3f}s {2:8.2f} MB/s".format(name, seconds, nbytes / seconds / 2**20))
+
+
+def small_payloads():
+    with open(ENGLISH_FILE, "rb") as inf:
+        english = inf.read()
+
+    payloads = []
+    for index in range(BATCH_COUNT):
+        start = (index * 97) % (len(english) - BATCH_PAYLOAD_SIZE)
+        payloads.append(english[start:start + BATCH_PAYLOAD_SIZE])
+
+    return payloads
+
+
+def bench_batches():
+    payloads = small_payloads()
+    nbytes = sum(len(p) for p in payloads)
+    name = "{0} x {1}B".format(BATCH_COUNT, BATCH_PAYLOAD_SIZE)
+
+    _, seconds = timed(lambda: [ b"".join(lzw.compress(p)) for p in payloads ])
+    report("compress, " + name, nbytes, seconds)
+
+    compressed, seconds = timed(lzw.compress_many, payloads)
+    report("compress_many, " + name, nbytes, seconds)
+
+    _, seconds = timed(lzw.compress_many, payloads, workers=4)
+    report("compress_many (4 workers), " + name, nbytes, seconds)
+
+    _, seconds = timed(lambda: [ b"".join(lzw.decompress(c)) for c in compressed ])
+    report("decompress, " + name, nbytes, seconds)
+
+    _, seconds = timed(lzw.decompress_many, compressed)
+    report("decompress_many, " + name, nbytes, seconds)
+
+    _, seconds = timed(lzw.decompress_many, compressed, workers=4)
+    report("decompress_many (4 workers), " + name, nbytes, seconds)
+
+
+def bench_lookahead():
+    with open(ENGLISH_FILE, "rb") as inf:
+        english = inf.read()
+    with open(PPM_FILE, "rb") as inf:
+        ppm = inf.read(PPM_BENCH_SIZE)
+
+    for (name, data) in (("english", english), ("ppm", ppm)):
+        for lookahead in (0, 1, 2):
+            compressed, seconds = timed(lambda: b"".join(lzw.compress(data, lookahead=lookahead)))
+            report("compress (lookahead {0}), {1}, ratio {2:.4f}".format(
+                    lookahead, name, float(len(data)) / len(compressed)), len(data), seconds)
+
+
+if __name__ == "__main__":
+    bench_batches()
+    bench_lookahead()
@@ -6,6 +6,11 @@ import random
 import six
 import struct
 import os
+import tempfile
+import shutil
+import threading
+import binascii
+import array
 
 
 # These tests are less interesting than the doctests inside of the lzw
@@ -115,3 +120,704 @@ class TestEncoder(unittest.TestCase):
         
         self.assertEqual(gibberish, decompressed)
 
+
+
+    def test_preset_dictionary(self):
+        paragraphs = self.english.split(b"\n\n")
+        preset = lzw.PresetDictionary(paragraphs[:1])
+
+        for paragraph in paragraphs[1:20]:
+            compressed = b"".join(lzw.compress(paragraph, preset=preset))
+            decompressed = b"".join(lzw.decompress(compressed, preset=[ lzw.PresetDictionary([]), preset ]))
+            self.assertEqual(paragraph, decompressed)
+
+        compressed = b"".join(lzw.compress(paragraphs[0], preset=preset))
+        self.assertTrue(len(compressed) < len(b"".join(lzw.compress(paragraphs[0]))))
+        self.assertRaises(ValueError, lambda: b"".join(lzw.decompress(compressed)))
+
+
+    def test_train_dictionary(self):
+        paragraphs = self.english.split(b"\n\n")
+        preset = lzw.train_dictionary(paragraphs[:40], max_entries=512)
+        self.assertTrue(len(preset.entries) <= 512)
+
+        with tempfile.NamedTemporaryFile() as dictfile:
+            lzw.writedictionary(dictfile.name, preset)
+            loaded = lzw.readdictionary(dictfile.name)
+
+        self.assertEqual(preset.dictionary_id, loaded.dictionary_id)
+        self.assertEqual(preset.entries, loaded.entries)
+
+        for junk in (b"", b"LZWD"):
+            with tempfile.NamedTemporaryFile() as dictfile:
+                dictfile.write(junk)
+                dictfile.flush()
+                self.assertRaises(ValueError, lzw.readdictionary, dictfile.name)
+            self.assertRaises(ValueError, lzw.dictionaryfrombytes, junk)
+
+        plainsize = 0
+        presetsize = 0
+        for paragraph in paragraphs[40:80]:
+            compressed = b"".join(lzw.compress(paragraph, preset=preset))
+            self.assertEqual(paragraph, b"".join(lzw.decompress(compressed, preset=loaded)))
+            presetsize = presetsize + len(compressed)
+            plainsize = plainsize + len(b"".join(lzw.compress(paragraph)))
+
+        self.assertTrue(presetsize < plainsize)
+
+
+    def test_decompress_into(self):
+        compressed = b"".join(lzw.compress(self.english))
+
+        out = bytearray(len(self.english) + 10)
+        written = lzw.decompress_into(compressed, memoryview(out)[5:])
+        self.assertEqual(len(self.english), written)
+        self.assertEqual(self.english, bytes(out[5:5 + written]))
+
+        out = bytearray(len(self.english) - 1)
+        try:
+            lzw.decompress_into(compressed, out)
+            self.fail("Expected a BufferTooSmallError")
+        except lzw.BufferTooSmallError as e:
+            self.assertEqual(len(out), e.written)
+            self.assertEqual(self.english[:len(out)], bytes(out))
+
+        # Buffers of wider items are written as bytes, where memoryviews
+        # can be cast (Python 3); otherwise they're refused
+        words = array.array("I", [ 0 ] * (len(self.english) // 4 + 1))
+        if hasattr(memoryview, "cast"):
+            written = lzw.decompress_into(compressed, words)
+            self.assertEqual(self.english, words.tobytes()[:written])
+        else:
+            self.assertRaises(TypeError, lzw.decompress_into, compressed, words)
+
+
+    def test_lzwfile(self):
+        with tempfile.TemporaryFile() as compressedfile:
+            with lzw.open(compressedfile, "wb", page_size=4096) as outfile:
+                outfile.write(self.english[:1000])
+                outfile.write(self.english[1000:])
+
+            compressedfile.seek(0)
+            compressed = compressedfile.read()
+
+            pgdec = lzw.PagingDecoder(initial_code_size=258)
+            pages = [ b"".join(pg) for pg in pgdec.decodepages(compressed) ]
+            self.assertEqual(self.english, b"".join(pages))
+            self.assertEqual(4096, len(pages[0]))
+
+            compressedfile.seek(0)
+            with lzw.open(compressedfile, buffersize=1024) as infile:
+                self.assertEqual(self.english[:100], infile.read(100))
+                infile.seek(9000)
+                self.assertEqual(self.english[9000:9100], infile.read(100))
+                infile.seek(5000)
+                self.assertEqual(self.english[5000:5100], infile.read(100))
+                infile.seek(0)
+
+                copied = six.BytesIO()
+                shutil.copyfileobj(infile, copied)
+                self.assertEqual(self.english, copied.getvalue())
+
+        # Like a Python 2 file, no seekable(), but tell() and seek() work
+        class OldFile(object):
+            def __init__(self, data):
+                self._stream = six.BytesIO(data)
+                self.read = self._stream.read
+                self.tell = self._stream.tell
+                self.seek = self._stream.seek
+
+        with lzw.open(OldFile(compressed)) as infile:
+            self.assertTrue(infile.seekable())
+            infile.seek(9000)
+            self.assertEqual(self.english[9000:9100], infile.read(100))
+            infile.seek(0)
+            self.assertEqual(self.english[:100], infile.read(100))
+
+
+    def test_codec_cache(self):
+        directory = tempfile.mkdtemp()
+        try:
+            cache = lzw.CodecCache(max_bytes=len(self.english), directory=directory)
+            compressed = cache.compress(self.english)
+            self.assertEqual(self.english, cache.decompress(compressed))
+            self.assertEqual(self.english, cache.decompress(compressed))
+            self.assertEqual((1, 2, 1), (cache.memory.hits, cache.memory.misses, cache.memory.evictions))
+
+            cache = lzw.CodecCache(max_bytes=len(self.english), directory=directory)
+            self.assertEqual(compressed, cache.compress(self.english))
+            self.assertEqual(1, cache.disk_hits)
+
+            # Other settings, same directory: never served each other's results
+            preset = lzw.PresetDictionary([ b"the Prince", b"Swallow" ])
+            cache = lzw.CodecCache(max_bytes=len(self.english), directory=directory, preset=preset)
+            withpreset = cache.compress(self.english)
+            self.assertEqual(b"".join(lzw.compress(self.english, preset=preset)), withpreset)
+            self.assertEqual(self.english, cache.decompress(withpreset))
+            self.assertRaises(ValueError, lzw.CodecCache, 2**20, preset=[ preset, lzw.PresetDictionary([]) ])
+
+            cache = lzw.CodecCache(max_bytes=len(self.english), directory=directory, max_width=10)
+            encoder = lzw.ByteEncoder(max_width=10)
+            self.assertEqual(encoder.encodechunk(self.english) + encoder.flush(), cache.compress(self.english))
+            self.assertEqual(0, cache.disk_hits)
+        finally:
+            shutil.rmtree(directory)
+
+
+    def test_compress_many(self):
+        payloads = [ self.english[start:start + 700] for start in range(0, len(self.english), 500) ]
+        payloads.append(b"")
+
+        compressed = lzw.compress_many(payloads)
+        self.assertEqual([ b"".join(lzw.compress(p)) for p in payloads ], compressed)
+        self.assertEqual(compressed, lzw.compress_many(payloads, workers=2))
+
+        self.assertEqual(payloads, lzw.decompress_many(compressed))
+        self.assertEqual(payloads, lzw.decompress_many(compressed, workers=2))
+
+
+    def test_paged_checksums(self):
+        pages = [ self.english[start:start + 3000] for start in range(0, len(self.english), 3000) ]
+
+        plain = b"".join(lzw.PagingEncoder(258, 2**12).encodepages(pages))
+        coded = b"".join(lzw.PagingEncoder(258, 2**12, checksums=True).encodepages(pages))
+
+        # Long pages, so the (historical) 257 in here used to matter
+        pgdec = lzw.PagingDecoder(initial_code_size=257)
+        self.assertEqual(pages + [ b"" ], [ b"".join(pg) for pg in pgdec.decodepages(plain) ])
+        self.assertEqual(pages + [ b"" ], [ b"".join(pg) for pg in pgdec.decodepages(coded) ])
+
+        self.assertEqual([], lzw.verifypages(coded, workers=4))
+        self.assertRaises(ValueError, lzw.verifypages, plain)
+
+        damaged = bytearray(coded)
+        damaged[len(coded) // 2] = damaged[len(coded) // 2] ^ 0x10
+        bad = lzw.verifypages(damaged)
+        self.assertEqual(1, len(bad))
+        self.assertEqual([ len(pages) - 1 ], lzw.verifypages(coded[:-1]))
+
+        stream = six.BytesIO()
+        with lzw.open(stream, "wb", page_size=3000, checksums=True) as outfile:
+            outfile.write(self.english)
+
+        self.assertEqual(coded, stream.getvalue())
+
+        with lzw.open(six.BytesIO(coded)) as infile:
+            self.assertEqual(self.english, infile.read())
+            infile.seek(100)
+            self.assertEqual(self.english[100:200], infile.read(100))
+
+
+    def test_generators_stream(self):
+        consumed = []
+
+        def source(data):
+            for b in six.iterbytes(data):
+                consumed.append(b)
+                yield six.int2byte(b)
+
+        # Output comes as soon as there's input for it, not once
+        # the whole source has been read
+        packed = b"".join(lzw.compress(self.english))
+        compressed = lzw.compress(source(self.english))
+        head = next(compressed)
+        self.assertTrue(len(consumed) < 10)
+        self.assertEqual(packed, head + b"".join(compressed))
+
+        del consumed[:]
+        next(lzw.decompress(source(packed)))
+        self.assertTrue(len(consumed) < 10)
+
+        # Generators over one packer or unpacker don't share bits
+        # (the first stream is the shorter, so zip drops nothing)
+        codes1 = list(lzw.Encoder().encode(self.english[:5000]))
+        codes2 = list(lzw.Encoder().encode(self.english[5000:15000]))
+        packer = lzw.BitPacker(258)
+        (first, second) = (packer.pack(codes1), packer.pack(codes2))
+        interleaved = [ b"", b"" ]
+        for (one, two) in six.moves.zip(first, second):
+            interleaved[0] = interleaved[0] + one
+            interleaved[1] = interleaved[1] + two
+        interleaved[0] = interleaved[0] + b"".join(first)
+        interleaved[1] = interleaved[1] + b"".join(second)
+        self.assertEqual(b"".join(lzw.BitPacker(258).pack(codes1)), interleaved[0])
+        self.assertEqual(b"".join(lzw.BitPacker(258).pack(codes2)), interleaved[1])
+
+        unpacker = lzw.BitUnpacker(258)
+        (first, second) = (unpacker.unpack(interleaved[0]), unpacker.unpack(interleaved[1]))
+        self.assertEqual([ (a, b) for (a, b) in six.moves.zip(codes1, codes2) ],
+                         [ (a, b) for (a, b) in six.moves.zip(first, second) ])
+
+
+    def test_preset_paged_checksums(self):
+        preset = lzw.PresetDictionary([ b"the Prince", b"Swallow" ])
+        stream = six.BytesIO()
+        with lzw.open(stream, "wb", page_size=3000, preset=preset, checksums=True) as outfile:
+            outfile.write(self.english)
+        coded = stream.getvalue()
+
+        with lzw.open(six.BytesIO(coded), preset=preset) as infile:
+            self.assertEqual(self.english, infile.read())
+            infile.seek(7000)
+            self.assertEqual(self.english[7000:7100], infile.read(100))
+
+        self.assertEqual(len(self.english), lzw.decompressed_size(coded, preset=preset))
+        self.assertEqual([], lzw.verifypages(coded))
+
+        damaged = bytearray(coded)
+        damaged[-5] = damaged[-5] ^ 0x10
+        self.assertEqual(1, len(lzw.verifypages(damaged)))
+
+
+    def test_paging_generators(self):
+        pages = [ self.english[start:start + 4000] for start in range(0, len(self.english), 4000) ]
+        expected = b"".join(lzw.PagingEncoder(258, 2**12).encodepages(pages))
+
+        # Generators on one PagingEncoder, in several threads, don't
+        # share codecs
+        encoder = lzw.PagingEncoder(258, 2**12)
+        results = {}
+
+        def work(number):
+            results[ number ] = b"".join(encoder.encodedpages(pages))
+
+        threads = [ threading.Thread(target=work, args=(number,)) for number in range(4) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([ expected ] * 4, [ results[ number ] for number in range(4) ])
+
+        # Nor do interleaved generators on one PagingDecoder
+        pgdec = lzw.PagingDecoder(258)
+        (first, second) = (pgdec.decodepages(expected), pgdec.decodepages(expected))
+        for page in pages:
+            self.assertEqual(page, b"".join(next(first)))
+            self.assertEqual(page, b"".join(next(second)))
+
+
+    def test_large_paged_checksums(self):
+        # Pages spanning more than one DEFAULT_CHUNK_SIZE read
+        rng = random.Random(4321)
+        pages = [ bytes(bytearray(rng.randint(0, 255) for i in range(100000))) for page in range(2) ]
+        coded = b"".join(lzw.PagingEncoder(258, 2**12, checksums=True).encodepages(pages))
+        self.assertTrue(len(coded) > lzw.DEFAULT_CHUNK_SIZE)
+
+        pgdec = lzw.PagingDecoder(258)
+        self.assertEqual(pages + [ b"" ], [ b"".join(pg) for pg in pgdec.decodepages(coded) ])
+
+        reader = lzw._PageReader(b"x" * 70000 + b"y" * 10)
+        self.assertEqual(b"x" * 65530, reader.read(65530))
+        self.assertEqual(b"x" * 4470 + b"y" * 10, reader.read(5000))
+        self.assertEqual(70010, reader.position)
+        self.assertEqual(b"", reader.read(20))
+
+
+    def test_decompression_limits(self):
+        compressed = b"".join(lzw.compress(self.english))
+
+        self.assertEqual(self.english, b"".join(lzw.decompress(compressed, max_output=len(self.english))))
+        self.assertRaises(lzw.DecompressionLimitError,
+                          lambda: b"".join(lzw.decompress(compressed, max_output=len(self.english) - 1)))
+        self.assertRaises(lzw.DecompressionLimitError,
+                          lambda: b"".join(lzw.decompress(compressed, max_ratio=1.5)))
+
+        # A small bomb early in a chunk trips the ratio limit, however
+        # incompressible the rest of the chunk is
+        rng = random.Random(99)
+        noise = bytes(bytearray(rng.randrange(256) for b in range(40000)))
+        bomb = b"".join(lzw.compress(b"\0" * 1000000 + noise))
+        self.assertTrue(len(bomb) < lzw.DEFAULT_CHUNK_SIZE)
+        decoder = lzw.ByteDecoder(max_ratio=50)
+        self.assertRaises(lzw.DecompressionLimitError, decoder.decodechunk, bomb)
+        self.assertTrue(decoder.bytes_out < 50 * 2000)
+
+        # Garbage should fail with a ValueError of some sort (usually
+        # InvalidCodeError), never something from deep inside the decoder.
+        rng = random.Random(1234)
+        for attempt in range(200):
+            garbage = bytearray(rng.randrange(256) for b in range(64))
+            garbage[0] = garbage[0] & 0x7F
+            try:
+                b"".join(lzw.decompress(bytes(garbage), max_output=10000))
+            except ValueError:
+                pass
+
+
+    def test_codec_reset_and_pool(self):
+        encoder = lzw.Encoder()
+        encoder.encodechunk(self.english[:1000])
+        encoder.reset()
+        self.assertEqual(list(lzw.Encoder().encode(self.english)), list(encoder.encode(self.english)))
+
+        decoder = lzw.Decoder()
+        codepoints = list(lzw.Encoder().encode(self.english))
+        b"".join(decoder.decode(codepoints[:500]))
+        decoder.reset()
+        self.assertEqual(self.english, b"".join(decoder.decode(codepoints)))
+
+        pool = lzw.CodecPool(max_idle=2)
+        payloads = [ self.english[start:start + 2000] for start in range(0, len(self.english), 1000) ]
+        results = {}
+
+        def work(index):
+            results[ index ] = pool.decompress(pool.compress(payloads[ index ]))
+
+        threads = [ threading.Thread(target=work, args=(index,)) for index in range(len(payloads)) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(payloads, [ results[ index ] for index in range(len(payloads)) ])
+
+
+    def test_command_line(self):
+        import lzw.__main__
+
+        directory = tempfile.mkdtemp()
+        try:
+            compressed = os.path.join(directory, "english.lzw")
+            restored = os.path.join(directory, "english.txt")
+
+            lzw.__main__.main([ "-c", ENGLISH_FILE, "-o", compressed ])
+            self.assertEqual(b"".join(lzw.compress(self.english)), open(compressed, "rb").read())
+
+            lzw.__main__.main([ "-d", compressed, "-o", restored ])
+            self.assertEqual(self.english, open(restored, "rb").read())
+
+            lzw.__main__.main([ "-c", "--paged", "--page-size", "4096", "--checksums", "-j", "2",
+                                ENGLISH_FILE, "-o", compressed ])
+            paged = open(compressed, "rb").read()
+            self.assertEqual([], lzw.verifypages(paged))
+
+            lzw.__main__.main([ "-d", compressed, "-o", restored ])
+            self.assertEqual(self.english, open(restored, "rb").read())
+
+            lzw.__main__.main([ "-d", "--paged", "--checksums", compressed, "-o", restored ])
+            self.assertEqual(self.english, open(restored, "rb").read())
+
+            # Bad input is an error exit, not a traceback
+            damaged = bytearray(paged)
+            damaged[len(paged) // 2] = damaged[len(paged) // 2] ^ 0x10
+            with open(compressed, "wb") as damagedfile:
+                damagedfile.write(bytes(damaged))
+            for arguments in ([ "-d", "--paged", "--checksums", compressed ], [ "-d", ENGLISH_FILE ],
+                              [ "-d", "--paged", "--checksums", ENGLISH_FILE ]):
+                try:
+                    lzw.__main__.main(arguments + [ "-o", restored ])
+                    self.fail("Expected an error exit")
+                except SystemExit as e:
+                    self.assertEqual(1, e.code)
+
+            self.assertRaises(SystemExit, lzw.__main__.main, [ "-c", "--paged", "--page-size", "0", ENGLISH_FILE ])
+
+            # Paging options without --paged are mistakes, not no-ops
+            for option in ([ "--checksums" ], [ "--page-size", "4096" ], [ "-j", "2" ]):
+                self.assertRaises(SystemExit, lzw.__main__.main, [ "-c", ENGLISH_FILE, "-o", compressed ] + option)
+        finally:
+            shutil.rmtree(directory)
+
+
+    def test_horizontal_predictor(self):
+        self.assertRaises(ValueError, lzw.HorizontalPredictor, 100, pixel_size=6, bits_per_sample=16)
+        predictor = lzw.HorizontalPredictor(100, pixel_size=3)
+        gradient = bytearray()
+        for row in range(40):
+            for column in range(100):
+                gradient.extend([ (row + column) % 256, (2 * column) % 256, row ])
+        gradient = bytes(gradient) + b"\x01\x02\x03\x04"
+
+        predicted = b"".join(predictor.encode(iter(gradient)))
+        self.assertEqual(predictor.encodechunk(gradient), predicted)
+        self.assertEqual(gradient, predictor.decodechunk(predicted))
+
+        compressed = b"".join(lzw.compress(predictor.encode(gradient)))
+        self.assertTrue(len(compressed) < len(b"".join(lzw.compress(gradient))))
+        self.assertEqual(gradient, b"".join(predictor.decode(lzw.decompress(compressed))))
+
+
+    def test_pdf_early_change(self):
+
+        def reference(data, early_change):
+            # LZWDecode as the PDF spec describes it, widths and all
+            value = int(binascii.hexlify(data), 16)
+            remaining = len(data) * 8
+            table = [ six.int2byte(b) for b in range(256) ] + [ None, None ]
+            (width, previous, decoded) = (9, None, [])
+
+            while remaining >= width:
+                remaining = remaining - width
+                code = (value >> remaining) & ((1 << width) - 1)
+                if code == lzw.CLEAR_CODE:
+                    (table, width, previous) = (table[:258], 9, None)
+                    continue
+                if code == lzw.END_OF_INFO_CODE:
+                    break
+
+                entry = table[code] if code < len(table) else previous + previous[:1]
+                if previous is not None:
+                    table.append(previous + entry[:1])
+                    if len(table) + early_change >= (1 << width) and width < 12:
+                        width = width + 1
+
+                decoded.append(entry)
+                previous = entry
+
+            return b"".join(decoded)
+
+        randomish = bytes(bytearray(random.randint(0, 255) for i in range(30000)))
+        for early_change in (0, 1):
+            for text in (self.english, randomish):
+                compressed = b"".join(lzw.compress(text, early_change=early_change))
+                self.assertEqual(text, reference(compressed, early_change))
+                self.assertEqual(text, b"".join(lzw.decompress(compressed + b"\n", early_change=early_change)))
+
+        self.assertNotEqual(b"".join(lzw.compress(self.english, early_change=0)),
+                            b"".join(lzw.compress(self.english, early_change=1)))
+
+
+    def test_checkpoints(self):
+        preset = lzw.PresetDictionary([ b"the Prince", b"Swallow" ])
+        expected = b"".join(lzw.compress(self.english, preset=preset))
+
+        encoder = lzw.ByteEncoder(preset=preset)
+        compressed = b""
+        for start in range(0, len(self.english), 3001):
+            compressed = compressed + encoder.encodechunk(self.english[start:start + 3001])
+            snapshot = encoder.checkpoint()
+            encoder = lzw.ByteEncoder(preset=preset)
+            encoder.restore(snapshot)
+            self.assertEqual((min(start + 3001, len(self.english)), len(compressed)),
+                             (encoder.bytes_in, encoder.bytes_out))
+
+        self.assertEqual(expected, compressed + encoder.flush())
+        self.assertRaises(ValueError, lzw.ByteEncoder().restore, snapshot)
+        self.assertRaises(ValueError, lzw.ByteDecoder(preset=preset).restore, snapshot)
+        self.assertRaises(ValueError, lzw.ByteEncoder(max_width=10, preset=preset).restore, snapshot)
+
+        pages = [ self.english[start:start + 5000] for start in range(0, len(self.english), 5000) ]
+        paged = b"".join(lzw.PagingEncoder(258, 2**12, checksums=True).encodepages(pages))
+
+        for (stream, chunksize) in ((expected, 777), (paged, 9), (paged, 1234)):
+            decoder = lzw.ByteDecoder(preset=preset)
+            decoded = b""
+            for start in range(0, len(stream), chunksize):
+                decoded = decoded + decoder.decodechunk(stream[start:start + chunksize])
+                snapshot = decoder.checkpoint()
+                decoder = lzw.ByteDecoder(preset=preset)
+                decoder.restore(snapshot)
+                self.assertEqual(len(decoded), decoder.bytes_out)
+
+            self.assertEqual(self.english, decoded)
+
+
+    def test_append_pages(self):
+        directory = tempfile.mkdtemp()
+        try:
+            for checksums in (False, True):
+                filename = os.path.join(directory, "archive.lzw")
+                with lzw.open(filename, "wb", page_size=4000, checksums=checksums) as outfile:
+                    outfile.write(self.english[:10000])
+
+                # A writer that died halfway through its last page
+                with open(filename, "r+b") as archive:
+                    archive.seek(-30, os.SEEK_END)
+                    archive.truncate()
+
+                with lzw.open(filename, "ab", page_size=4000) as outfile:
+                    outfile.write(self.english[8000:])
+
+                data = open(filename, "rb").read()
+                self.assertEqual(self.english, b"".join(lzw.decompress(data)))
+                if checksums:
+                    self.assertEqual([], lzw.verifypages(data))
+
+            lzw.writebytes(filename, lzw.compress(self.english))
+            self.assertRaises(ValueError, lzw.open, filename, "ab", page_size=4000)
+        finally:
+            shutil.rmtree(directory)
+
+
+    def test_decompressed_size(self):
+        preset = lzw.PresetDictionary([ b"the Prince", b"Swallow" ])
+        randomish = bytes(bytearray(random.randint(0, 255) for i in range(20000)))
+        text = self.english + randomish + self.english
+
+        self.assertEqual(len(text), lzw.decompressed_size(lzw.compress(text)))
+        self.assertEqual(len(text), lzw.decompressed_size(lzw.compress(text, preset=preset), preset=preset))
+        self.assertEqual(len(text), lzw.decompressed_size(lzw.compress(text, early_change=0), early_change=0))
+
+        pages = [ text[start:start + 7000] for start in range(0, len(text), 7000) ]
+        for checksums in (False, True):
+            paged = lzw.PagingEncoder(258, 2**12, checksums=checksums).encodepages(pages)
+            self.assertEqual([ len(page) for page in pages ], lzw.decompressed_page_sizes(paged))
+
+        self.assertRaises(lzw.InvalidCodeError, lzw.decompressed_size, lzw.BitPacker(258).packchunk([ 103, 300, 0 ]))
+
+
+    def test_page_cache(self):
+        directory = tempfile.mkdtemp()
+        try:
+            pages = [ self.english[start:start + 1000] for start in range(0, len(self.english), 1000) ]
+            cache = lzw.PageCache(max_bytes=5000)
+
+            for checksums in (False, True):
+                filename = os.path.join(directory, "archive{0}.lzw".format(checksums))
+                lzw.writebytes(filename, lzw.PagingEncoder(258, 2**12, checksums=checksums).encodepages(pages))
+                self.assertEqual(len(pages), cache.pagecount(filename))
+
+                results = {}
+
+                def work(number):
+                    results[ number ] = [ cache.page(filename, (number * 7 + i) % len(pages)) for i in range(10) ]
+
+                threads = [ threading.Thread(target=work, args=(number,)) for number in range(8) ]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+
+                for number in range(8):
+                    self.assertEqual([ pages[ (number * 7 + i) % len(pages) ] for i in range(10) ], results[ number ])
+
+                self.assertEqual(self.english[1500:4500], cache.read(filename, 1500, 3000))
+                self.assertRaises(IndexError, cache.page, filename, len(pages))
+
+            self.assertTrue(cache.memory.hits > 0 and cache.memory.evictions > 0)
+            self.assertTrue(cache.memory.size <= 5000)
+
+            # A rewritten file replaces its old index, rather than adding one
+            lzw.writebytes(filename, lzw.PagingEncoder(258, 2**12).encodepages(pages[:3]))
+            self.assertEqual(3, cache.pagecount(filename))
+            self.assertEqual(pages[2], cache.page(filename, 2))
+            self.assertEqual(2, len(cache._indexes))
+        finally:
+            shutil.rmtree(directory)
+
+
+    def test_page_cache_presets(self):
+        directory = tempfile.mkdtemp()
+        try:
+            pages = [ self.english[start:start + 1000] for start in range(0, 5000, 1000) ]
+            preset = lzw.PresetDictionary([ b"the Prince", b"Swallow" ])
+            filename = os.path.join(directory, "archive.lzw")
+            with lzw.open(filename, "wb", page_size=1000, preset=preset, checksums=True) as outfile:
+                outfile.write(b"".join(pages))
+
+            cache = lzw.PageCache(max_bytes=2**20, preset=preset)
+            self.assertEqual(pages[0], cache.page(filename, 0))
+            self.assertEqual(pages[3], cache.page(filename, 3))
+            self.assertRaises(ValueError, lzw.PageCache(max_bytes=2**20).page, filename, 0)
+
+            # A file replaced between indexing and reading is indexed
+            # again, not read with the old file's offsets
+            stale = cache._index(filename)
+            index = cache._index
+            calls = []
+            def staleonce(name):
+                calls.append(name)
+                return stale if len(calls) == 1 else index(name)
+            cache._index = staleonce
+
+            replacement = os.path.join(directory, "replacement.lzw")
+            lzw.writebytes(replacement, lzw.PagingEncoder(258, 2**12).encodepages(pages[::-1]))
+            os.rename(replacement, filename)
+            self.assertEqual(pages[3], cache.page(filename, 1))
+            self.assertEqual(2, len(calls))
+        finally:
+            shutil.rmtree(directory)
+
+
+    def test_multiplexing(self):
+        mux = lzw.Multiplexer()
+        sent = dict((channel, []) for channel in range(20))
+        stream = []
+
+        rand = random.Random(42)
+        for i in range(400):
+            channel = rand.randrange(20)
+            start = rand.randrange(len(self.english) - 200)
+            chunk = self.english[start:start + rand.randrange(200)]
+            sent[ channel ].append(chunk)
+            stream.append(mux.write(channel, chunk))
+            if i % 50 == 49:
+                stream.append(mux.flushall())
+
+        stream.append(b"".join(mux.close(channel) for channel in range(20)))
+
+        everything = lzw.Demultiplexer()
+        some = lzw.Demultiplexer(channels=[ 3, 7 ])
+        late = lzw.Demultiplexer(channels=[])
+        received = dict((channel, []) for channel in range(20))
+        picked = { 3: [], 7: [] }
+        latecomer = []
+
+        for (index, frames) in enumerate(stream):
+            if index == 200:
+                late.subscribe(5)
+
+            for (channel, data) in everything.feed(frames):
+                received[ channel ].append(data)
+            for (channel, data) in some.feed(frames):
+                picked[ channel ].append(data)
+            for (channel, data) in late.feed(frames):
+                self.assertEqual(5, channel)
+                latecomer.append(data)
+
+        for channel in range(20):
+            self.assertEqual(b"".join(sent[ channel ]), b"".join(received[ channel ]))
+
+        self.assertEqual(b"".join(sent[ 3 ]), b"".join(picked[ 3 ]))
+        self.assertEqual(b"".join(sent[ 7 ]), b"".join(picked[ 7 ]))
+
+        latecomer = b"".join(latecomer)
+        self.assertTrue(latecomer and b"".join(sent[ 5 ]).endswith(latecomer))
+
+        # A long-lived channel's decoder doesn't pile up page offsets
+        demux = lzw.Demultiplexer()
+        for i in range(500):
+            decoded = demux.feed(mux.write(1, b"gabba") + mux.flush(1))
+            self.assertEqual(b"gabba", b"".join(data for (channel, data) in decoded))
+        self.assertTrue(len(demux._decoders[ 1 ].pages) <= 1)
+
+
+    def test_flexible_encoder(self):
+        randomish = bytes(bytearray(random.randint(0, 3) for i in range(8000)))
+        preset = lzw.PresetDictionary([ b"the Prince", b"Swallow" ])
+
+        for text in (self.english, randomish):
+            for lookahead in (1, 2):
+                compressed = b"".join(lzw.compress(text, lookahead=lookahead))
+                self.assertEqual(text, b"".join(lzw.decompress(compressed)))
+
+                # Decoding resumes from a checkpoint, duplicate strings and all
+                decoder = lzw.ByteDecoder()
+                head = decoder.decodechunk(compressed[:len(compressed) // 2])
+                resumed = lzw.ByteDecoder()
+                resumed.restore(decoder.checkpoint())
+                self.assertEqual(text, head + resumed.decodechunk(compressed[len(compressed) // 2:]))
+
+                encoder = lzw.ByteEncoder(lookahead=lookahead, preset=preset)
+                compressed = b"".join(encoder.encodechunk(text[start:start + 999])
+                                      for start in range(0, len(text), 999)) + encoder.flush()
+                self.assertEqual(text, b"".join(lzw.decompress(compressed, preset=preset)))
+
+                compressed = b"".join(lzw.compress(text, early_change=0, lookahead=lookahead))
+                self.assertEqual(text, b"".join(lzw.decompress(compressed, early_change=0)))
+
+        self.assertTrue(len(b"".join(lzw.compress(self.english, lookahead=2))) <
+                        len(b"".join(lzw.compress(self.english))))
+
+
+    def test_decompress_head(self):
+        compressed = b"".join(lzw.compress(self.english * 20))
+        stream = six.BytesIO(compressed)
+
+        self.assertEqual(self.english[:2000], lzw.decompress_head(stream, 2000))
+        self.assertEqual(2048, stream.tell())
+
+        self.assertEqual(self.english[:10], lzw.decompress_head(iter(compressed), 10))
+        self.assertEqual(self.english * 20, lzw.decompress_head(compressed, 10**9))
+        self.assertEqual(b"", lzw.decompress_head(compressed, 0))